@@ -0,0 +1,348 @@
+"""Бенчмарк загрузки товаров на локальном подменном сервере iHerb.
+
+Сервер отдаёт sitemap, товар, рекомендации и UGC с заданным распределением задержек,
+долей ошибок 500 и ответов 429. Каждый прогон (движок x число воркеров) идёт в отдельном
+процессе, чтобы пиковый RSS считался честно.
+
+    python bench.py --items 2000 --engines threads,async --workers 10,40,100
+    python bench.py --latency-ms 80 --latency-sigma 0.6 --error-rate 0.01 --throttle-rate 0.02
+    python bench.py --check-resume --items 50   # --incremental --resume не дублирует товары
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+PRODUCTS_PER_SITEMAP = 5000
+FIRST_ID = 100000
+
+
+# === Подменные данные ===
+def make_product(item_id):
+    """Правдоподобный ответ catalog.app.iherb.com/product/{id} с теми полями, которые читает parse_item"""
+    rnd = random.Random(item_id)
+    brand = rnd.choice(["California Gold Nutrition", "NOW Foods", "Doctor's Best", "Solgar", "Life Extension"])
+    brand_code = "".join(word[0] for word in brand.split()).upper() + "B"
+    part_number = f"{brand_code}-{rnd.randint(10000, 99999)}"
+    category = rnd.choice(["Supplements", "Sports Nutrition", "Bath & Personal Care"])
+    paragraphs = "".join(
+        f"<p>Lorem ipsum {i} dolor sit amet, <b>consectetur</b> adipiscing&nbsp;elit.</p><ul><li>Point {i}</li></ul><br/>"
+        for i in range(rnd.randint(2, 8))
+    )
+    return {
+        "id": item_id,
+        "displayName": f"{brand}, Product {item_id}, {rnd.randint(30, 240)} Veggie Capsules",
+        "brandName": brand,
+        "brandCode": brand_code,
+        "partNumber": part_number,
+        "url": f"https://www.iherb.com/pr/product-{item_id}/{item_id}",
+        "imageIndices": list(range(rnd.randint(0, 6))),
+        "imageIndices360": list(range(rnd.randint(0, 3))),
+        "primaryImageIndex": rnd.randint(0, 5),
+        "rootCategoryName": category,
+        "rootCategoryId": rnd.randint(1, 3000),
+        "packageQuantity": f"{rnd.randint(30, 240)} Count",
+        "listPrice": rnd.choice([
+            {"amount": round(rnd.uniform(2, 90), 2), "currencyCode": "USD"},
+            f"${rnd.uniform(2, 90):.2f}",
+        ]),
+        "isAvailableToPurchase": rnd.random() > 0.1,
+        "dimensions": f"{rnd.uniform(5, 15):.1f} x {rnd.uniform(2, 8):.1f} x {rnd.uniform(2, 8):.1f} cm",
+        "actualWeight": {"amount": round(rnd.uniform(0.05, 1.5), 2), "unit": "kg"},
+        "formattedExpirationDate": f"{rnd.randint(1, 12):02d}/{rnd.randint(2026, 2029)}",
+        "formattedOnSaleDate": f"{rnd.randint(1, 12):02d}/{rnd.randint(2010, 2025)}",
+        "averageRating": round(rnd.uniform(3, 5), 1),
+        "totalRatingCount": rnd.randint(0, 50000),
+        "recentActivityMessage": f"{rnd.randint(100, 5000)}+ sold in 30 days",
+        "productRanks": [
+            {"categoryDisplayName": f"Category {rnd.randint(1, 500)}", "rank": rnd.randint(1, 100)}
+            for _ in range(rnd.randint(0, 4))
+        ],
+        "canonicalPaths": [
+            [{"displayName": brand}, {"displayName": "Brands A-Z"}],
+            [{"displayName": "Vitamins"}, {"displayName": category}, {"displayName": "Categories"}],
+        ],
+        "description": paragraphs,
+    }
+
+
+def make_recommendations(item_id):
+    rnd = random.Random(-item_id)
+    return {
+        "originProduct": {"name": f"Product {item_id}", "listPrice": f"${rnd.uniform(2, 90):.2f}"},
+        "recommendedProducts": [
+            {"name": f"Product {rnd.randint(FIRST_ID, FIRST_ID * 2)}", "listPrice": f"${rnd.uniform(2, 90):.2f}"}
+            for _ in range(2)
+        ],
+    }
+
+
+def make_ugc(item_id):
+    return {"productId": item_id, "upcCode": f"{733739000000 + item_id}"}
+
+
+# === Подменный сервер ===
+class MockIherbHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        config = self.server.config
+        url = urlsplit(self.path)
+        path = url.path
+
+        if path == "/sitemaps/index.xml":
+            return self._send(200, "application/xml", self._sitemap_index())
+        match = re.fullmatch(r"/sitemaps/products-(\d+)-www-0\.xml", path)
+        if match:
+            return self._send(200, "application/xml", self._sitemap(int(match.group(1))))
+
+        time.sleep(self._latency())
+        roll = random.random()
+        if roll < config.throttle_rate:
+            return self._send(429, "application/json", b'{"message": "Too Many Requests"}')
+        if roll < config.throttle_rate + config.error_rate:
+            return self._send(500, "application/json", b'{"message": "Internal Server Error"}')
+
+        if path.startswith("/product/"):
+            data = make_product(int(path.rsplit("/", 1)[-1]))
+        elif path == "/recommendations/freqpurchasedtogether":
+            data = make_recommendations(int(parse_qs(url.query)["productId"][0]))
+        elif path.startswith("/ugc/api/product/"):
+            data = make_ugc(int(path.rsplit("/", 1)[-1]))
+        else:
+            return self._send(404, "application/json", b"{}")
+        self._send(200, "application/json", json.dumps(data).encode())
+
+    def _latency(self):
+        config = self.server.config
+        if config.latency_ms <= 0:
+            return 0.0
+        # Логнормальное распределение: медиана latency_ms, хвост задаёт sigma
+        return random.lognormvariate(0, config.latency_sigma) * config.latency_ms / 1000
+
+    def _sitemap_index(self):
+        count = -(-self.server.config.items // PRODUCTS_PER_SITEMAP)
+        base = self.server.base_url
+        entries = "".join(
+            f"<sitemap><loc>{base}/sitemaps/products-{i}-www-0.xml</loc></sitemap>" for i in range(count)
+        )
+        return f'<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="{SITEMAP_NS}">{entries}</sitemapindex>'.encode()
+
+    def _sitemap(self, number):
+        first = FIRST_ID + number * PRODUCTS_PER_SITEMAP
+        last = min(FIRST_ID + self.server.config.items, first + PRODUCTS_PER_SITEMAP)
+        entries = "".join(
+            f"<url><loc>https://www.iherb.com/pr/product-{i}/{i}</loc><lastmod>2026-01-01</lastmod></url>"
+            for i in range(first, last)
+        )
+        return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{SITEMAP_NS}">{entries}</urlset>'.encode()
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockIherbServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, config):
+        super().__init__(("127.0.0.1", 0), MockIherbHandler)
+        self.config = config
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл keep-alive соединение при завершении прогона — это не ошибка сервера
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+def start_mock_server(config):
+    server = MockIherbServer(config)
+    threading.Thread(target=server.serve_forever, name="mock-iherb", daemon=True).start()
+    return server
+
+
+# === Один прогон (в отдельном процессе) ===
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def run_one(config):
+    """Прогоняем текущий движок против сервера config.server и печатаем JSON с результатом"""
+    import mod
+
+    mod.CATALOG_BASE_URL = mod.WWW_BASE_URL = config.server
+    mod.SITEMAP_INDEX_URL = f"{config.server}/sitemaps/index.xml"
+    mod.RATE_LIMITER.configure({})
+
+    latencies = []
+    fetch_item_json = mod.fetch_item_json
+    fetch_item_json_async = mod.fetch_item_json_async
+
+    def timed_fetch(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fetch_item_json(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    async def timed_fetch_async(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await fetch_item_json_async(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    mod.fetch_item_json = timed_fetch
+    mod.fetch_item_json_async = timed_fetch_async
+
+    failures = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        items = 0
+        batches = mod.get_items_json_batched(
+            mod.get_pages(), engine=config.engine, max_workers=config.workers,
+            on_failure=lambda link, error: failures.append(link),
+        )
+        for batch in batches:
+            items += len(batch)
+        elapsed = time.perf_counter() - started
+
+    # ru_maxrss в Linux — килобайты
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({
+        "engine": config.engine,
+        "workers": config.workers,
+        "items": items,
+        "failed": len(failures),
+        "elapsed": elapsed,
+        "items_per_sec": items / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "peak_rss_mb": peak_rss_mb,
+    }))
+
+
+# === Проверка повторного запуска ===
+RESUME_RUNS = (
+    ["--incremental"],
+    ["--incremental", "--resume"],
+)
+
+
+def check_resume(config):
+    """Полный запуск, затем --incremental и --incremental --resume: в iherb.json каждый товар ровно один раз"""
+    workdir = os.path.join(config.workdir, "check-resume")
+    shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(workdir)
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import mod
+
+    server = start_mock_server(config)
+    mod.CATALOG_BASE_URL = mod.WWW_BASE_URL = server.base_url
+    mod.SITEMAP_INDEX_URL = f"{server.base_url}/sitemaps/index.xml"
+    mod.RATE_LIMITS = {}
+    ok = True
+    for extra in [[]] + list(RESUME_RUNS):
+        argv = ["--no-cache", "--metrics-file", "", "--progress", "quiet"] + extra
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            mod.main_iherb(mod.parse_args(argv))
+        with open(mod.OUTPUT_FORMATS["json"][1], encoding="utf-8") as f:
+            ids = [record["ID"] for record in json.load(f)]
+        unique = len(set(ids))
+        passed = len(ids) == unique == config.items
+        ok = ok and passed
+        print(f"{'✅' if passed else '❌'} {' '.join(extra) or 'полный запуск'}: "
+              f"{len(ids)} записей, {unique} разных ID (ожидалось {config.items})")
+    server.shutdown()
+    return ok
+
+
+# === Сводка ===
+def run_matrix(config):
+    server = start_mock_server(config)
+    print(f"🧪 Подменный сервер: {server.base_url}, товаров: {config.items}, "
+          f"задержка ~{config.latency_ms} мс (sigma {config.latency_sigma}), "
+          f"ошибок 500: {config.error_rate:.1%}, 429: {config.throttle_rate:.1%}")
+    print(f"{'engine':<8} {'workers':>7} {'items':>6} {'failed':>6} {'items/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'RSS MB':>7}")
+    results = []
+    for engine in config.engines.split(","):
+        for workers in config.workers_list.split(","):
+            command = [
+                sys.executable, os.path.abspath(__file__), "--run-one",
+                "--server", server.base_url, "--engine", engine, "--workers", workers,
+            ]
+            output = subprocess.run(
+                command, check=True, capture_output=True, text=True, cwd=config.workdir,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{engine:<8} {result['workers']:>7} {result['items']:>6} {result['failed']:>6} "
+                  f"{result['items_per_sec']:>8.1f} {result['p50'] * 1000:>8.0f} {result['p95'] * 1000:>8.0f} "
+                  f"{result['p99'] * 1000:>8.0f} {result['peak_rss_mb']:>7.0f}")
+    server.shutdown()
+    if config.json:
+        with open(config.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Результаты сохранены в {config.json}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк загрузки товаров на подменном сервере iHerb")
+    parser.add_argument("--items", type=int, default=2000, help="сколько товаров в подменном sitemap")
+    parser.add_argument("--engines", default="threads,async", help="движки через запятую")
+    parser.add_argument("--workers", dest="workers_list", default="10,40,100",
+                        help="числа воркеров через запятую")
+    parser.add_argument("--latency-ms", type=float, default=50, help="медиана задержки ответа, мс")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="разброс логнормальной задержки")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    parser.add_argument("--check-resume", action="store_true",
+                        help="проверить, что --incremental --resume не дублирует товары в результатах (код выхода 1, если дублирует)")
+    parser.add_argument("--workdir", default=os.path.join("results", "bench"),
+                        help="рабочая папка прогонов (туда попадает их results/)")
+    # Внутренние параметры дочернего процесса
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--server", help=argparse.SUPPRESS)
+    parser.add_argument("--engine", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.run_one:
+        args.workers = int(args.workers_list)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.run_one:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        run_one(args)
+    elif args.check_resume:
+        sys.exit(0 if check_resume(args) else 1)
+    else:
+        os.makedirs(args.workdir, exist_ok=True)
+        run_matrix(args)
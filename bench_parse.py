@@ -0,0 +1,220 @@
+"""Микробенчмарк parse_item и проверка по эталонному (golden) файлу.
+
+Корпус — JSONL с ответами товаров в том виде, в каком их отдаёт fetch_item_json
+(с frequently_purchased_together и upcCode). Эталон — результаты parse_item по этому
+корпусу, записанные до оптимизаций; --check сверяет с ним текущую реализацию.
+
+    python bench_parse.py                     # скорость parse_item на корпусе
+    python bench_parse.py --check             # вывод совпадает с эталоном (код выхода 1, если нет)
+    python bench_parse.py --json-share        # доля JSON в CPU на товар: стандартный json и orjson
+    python bench_parse.py --from-cache results/cache --corpus my_corpus.jsonl --make-corpus
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench
+import mod
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_data")
+CORPUS_FILE = os.path.join(DATA_DIR, "products.jsonl")
+GOLDEN_FILE = os.path.join(DATA_DIR, "parse_golden.jsonl")
+
+# Товары, которые проходят по редким веткам parse_item (в т.ч. те, на которых он возвращает None)
+EDGE_CASES = [
+    {},
+    {"id": 1, "listPrice": "€12.50", "partNumber": "ABC-123"},
+    {"id": 2, "listPrice": "£3", "brandCode": "XYZ", "partNumber": "X-1", "primaryImageIndex": 7},
+    {"id": 3, "listPrice": "12.00", "actualWeight": "0.5 lb", "averageRating": 0, "totalRatingCount": 0},
+    {"id": 4, "listPrice": "$", "actualWeight": {"unit": "kg"}},
+    {"id": 5, "listPrice": {"currencyCode": "RUB"}, "productRanks": [
+        {"categoryDisplayName": "Vitamins: Multi", "rank": 3},
+        {"categoryDisplayName": "", "rank": ""},
+        {},
+    ]},
+    {"id": 6, "brandCode": "ABC", "partNumber": "ab-cd-12", "imageIndices": [], "imageIndices360": [1, 2],
+     "primaryImageIndex": 0},
+    {"id": 7, "description": "<div class='x'>A&nbsp;B</div><p>C</p><ul><li>D</li></ul>E<br>F<br/>G<a\nhref='#'>H</a>"},
+    {"id": 8, "description": "   <p>   </p>   "},
+    {"id": 9, "frequently_purchased_together": {"originProduct": {"name": "O", "listPrice": "$1"}}},
+    {"id": 10, "frequently_purchased_together": {"recommendedProducts": [{"name": "R"}, {}]}},
+    {"id": 11, "frequently_purchased_together": {}},
+    {"id": 12, "canonicalPaths": [[], [{"displayName": "X"}, {"displayName": "Brands A-Z"}],
+                                  [{"displayName": "Other"}], [{}, {"displayName": "Categories"}]]},
+    {"id": 13, "upcCode": "0123", "packageQuantity": "60 Count", "dimensions": "1 x 2 x 3",
+     "formattedExpirationDate": "01/2027", "formattedOnSaleDate": "02/2020"},
+    {"id": 14, "brandCode": 5},
+    {"id": 15, "canonicalPaths": [["not a dict"]]},
+    {"id": 16, "productRanks": [None]},
+    {"id": 0, "rootCategoryId": 0, "displayName": None, "brandName": None, "url": None},
+]
+
+
+def make_corpus(count):
+    corpus = []
+    for item_id in range(bench.FIRST_ID, bench.FIRST_ID + count):
+        item = bench.make_product(item_id)
+        mod.merge_optional_data(item, {
+            "recommendations": bench.make_recommendations(item_id),
+            "ugc": bench.make_ugc(item_id),
+        })
+        corpus.append(item)
+    return corpus + EDGE_CASES
+
+
+def corpus_from_cache(directory):
+    cache = mod.ResponseCache(directory)
+    try:
+        corpus = []
+        for _, product_data, optional_data in cache.iter_items():
+            mod.merge_optional_data(product_data, optional_data)
+            corpus.append(product_data)
+        return corpus
+    finally:
+        cache.close()
+
+
+def write_jsonl(filename, rows):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def read_jsonl(filename):
+    with open(filename, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def parse_quietly(corpus):
+    # parse_item печатает ошибки разбора, для граничных случаев это ожидаемо
+    with contextlib.redirect_stdout(io.StringIO()):
+        return [mod.parse_item(item) for item in corpus]
+
+
+def check(corpus, golden):
+    if len(corpus) != len(golden):
+        print(f"❌ В корпусе {len(corpus)} товаров, в эталоне {len(golden)}")
+        return False
+    mismatches = 0
+    for number, (actual, expected) in enumerate(zip(parse_quietly(corpus), golden)):
+        # Сравниваем через JSON: так же результат попадает в iherb.json
+        if json.loads(json.dumps(actual, ensure_ascii=False)) != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"❌ Товар #{number} (id={corpus[number].get('id')}):")
+                print(f"   ожидалось: {json.dumps(expected, ensure_ascii=False)[:400]}")
+                print(f"   получено:  {json.dumps(actual, ensure_ascii=False)[:400]}")
+    if mismatches:
+        print(f"❌ Расхождений с эталоном: {mismatches} из {len(golden)}")
+        return False
+    print(f"✅ Вывод parse_item совпадает с эталоном на {len(golden)} товарах")
+    return True
+
+
+def best_of(rounds, run, count):
+    """Лучшее из rounds время run(), в микросекундах на один из count товаров"""
+    best = float("inf")
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(rounds):
+            started = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - started)
+    return best / count * 1e6
+
+
+def benchmark(corpus, rounds):
+    """Лучшее из rounds время разбора всего корпуса, в микросекундах на товар"""
+    def run():
+        for item in corpus:
+            mod.parse_item(item)
+    return best_of(rounds, run, len(corpus))
+
+
+def json_share(corpus, rounds):
+    """CPU на товар: разбор ответов API, parse_item и запись результатов — для каждого JSON-бэкенда.
+
+    Ответы берём в том виде, в каком их отдаёт API (json.dumps без настроек). На запись товар
+    кодируется трижды: в iherb.json (indent=2), в журнал и в кэш ответов.
+    """
+    raw = [json.dumps(item).encode("utf-8") for item in corpus]
+    pairs = [(item, record) for item, record in zip(corpus, parse_quietly(corpus)) if record]
+
+    def decode():
+        for body in raw:
+            mod.json_loads(body)
+
+    def parse():
+        for item in corpus:
+            mod.parse_item(item)
+
+    def encode():
+        for item, record in pairs:
+            mod.json_dumps(record, indent=True)
+            mod.json_dumps(record)
+            mod.json_dumps_bytes(item)
+
+    backends = [("json", None)] + ([("orjson", mod.orjson)] if mod.orjson is not None else [])
+    installed = mod.orjson
+    try:
+        for name, backend in backends:
+            mod.orjson = backend
+            times = [best_of(rounds, decode, len(corpus)), best_of(rounds, parse, len(corpus)),
+                     best_of(rounds, encode, len(corpus))]
+            total = sum(times)
+            print(f"📊 {name}: {total:.1f} мкс/товар — разбор ответов {times[0]:.1f} ({times[0] / total:.0%}), "
+                  f"parse_item {times[1]:.1f} ({times[1] / total:.0%}), запись {times[2]:.1f} ({times[2] / total:.0%})")
+    finally:
+        mod.orjson = installed
+    if installed is None:
+        print("ℹ️ orjson не установлен (pip install orjson), измерен только стандартный json")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Микробенчмарк parse_item")
+    parser.add_argument("--corpus", default=CORPUS_FILE, help="JSONL с ответами товаров")
+    parser.add_argument("--golden", default=GOLDEN_FILE, help="JSONL с эталонным выводом parse_item")
+    parser.add_argument("--rounds", type=int, default=20, help="сколько раз прогнать корпус")
+    parser.add_argument("--check", action="store_true", help="сверить вывод с эталоном и выйти")
+    parser.add_argument("--json-share", action="store_true",
+                        help="сравнить долю разбора и записи JSON в CPU на товар для json и orjson")
+    parser.add_argument("--make-corpus", action="store_true",
+                        help="сгенерировать корпус (или взять из --from-cache) и записать в --corpus")
+    parser.add_argument("--count", type=int, default=100, help="сколько синтетических товаров в корпусе")
+    parser.add_argument("--from-cache", help="собрать корпус из кэша ответов (например, results/cache)")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="перезаписать эталон выводом текущей реализации")
+    return parser.parse_args(argv)
+
+
+def main(args):
+    if args.make_corpus:
+        corpus = corpus_from_cache(args.from_cache) if args.from_cache else make_corpus(args.count)
+        write_jsonl(args.corpus, corpus)
+        print(f"💾 Корпус из {len(corpus)} товаров сохранён в {args.corpus}")
+    corpus = read_jsonl(args.corpus)
+
+    if args.update_golden:
+        write_jsonl(args.golden, parse_quietly(corpus))
+        print(f"💾 Эталон для {len(corpus)} товаров сохранён в {args.golden}")
+        return 0
+    if args.check:
+        return 0 if check(corpus, read_jsonl(args.golden)) else 1
+    if args.json_share:
+        json_share(corpus, args.rounds)
+        return 0
+
+    per_item = benchmark(corpus, args.rounds)
+    print(f"⏱️ parse_item: {per_item:.1f} мкс/товар ({1e6 / per_item:,.0f} товаров/с на одно ядро), "
+          f"корпус {len(corpus)} товаров, лучшее из {args.rounds} прогонов")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -3,13 +3,102 @@ import random
 import json
 import re
 import os
-import xml.etree.ElementTree as ET
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import asyncio
+import queue
+import threading
+import itertools
+import collections
+import hashlib
+import sqlite3
+import zlib
+import gzip
+from urllib.parse import urlsplit
+import functools
+import contextlib
+import multiprocessing
+from xml.sax.saxutils import escape as xml_escape
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 import cloudscraper
-import lxml.html
+import lxml.etree
+import requests
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp нужен только для движка asyncio
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:  # без orjson работаем на стандартном json, только медленнее
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pyarrow нужен только для вывода в Parquet
+    pyarrow = None
 
 # === Настройки ===
-SITEMAP_URL = "https://www.iherb.com/sitemaps/products-0-www-0.xml"
+CATALOG_BASE_URL = "https://catalog.app.iherb.com"
+WWW_BASE_URL = "https://www.iherb.com"
+SITEMAP_INDEX_URL = f"{WWW_BASE_URL}/sitemaps/index.xml"
+SITEMAP_URL = f"{WWW_BASE_URL}/sitemaps/products-0-www-0.xml"
+PRODUCT_SITEMAP_PATTERN = re.compile(r"/products-\d+-www-\d+\.xml(\.gz)?$")
+SITEMAP_WORKERS = 4
+# Категории из README (cids на iherb.com/c/supplements) для --cids без списка
+CATEGORY_IDS = {
+    "Vitamins": 101072,
+    "Bones, Joints, and Cartilage": 100727,
+    "Micronutrients": 1800,
+    "Children's Health": 100349,
+    "Amino Acids": 1694,
+    "Brain Function": 105803,
+    "Women's Health": 8741,
+    "Fish Oil and Omega (EPA and DHA)": 1542,
+    "Men's Health": 3282,
+    "Phospholipids": 102094,
+}
+# Предохранитель: листинг категории, который не кончается, дальше этой страницы не читаем
+CATEGORY_MAX_PAGES = 1000
+ENGINES = ("threads", "async")
+# shared — одна сессия на все потоки, per-worker — своя сессия у каждого потока
+SESSION_MODES = ("shared", "per-worker")
+DEFAULT_WORKERS = {"threads": 40, "async": 500}
+XML_FILE = "results/iherb.xml"
+DEAD_LETTER_FILE = "results/dead_letter.jsonl"
+JOURNAL_FILE = "results/crawl_journal.sqlite"
+INDEX_FILE = "results/product_index.sqlite"
+CACHE_DIR = "results/cache"
+CLEARANCE_FILE = "results/cf_cookies.json"
+METRICS_FILE = "results/metrics.prom"
+METRICS_INTERVAL = 15
+# text — строка прогресса, json — та же сводка JSON-строкой (для сборщика логов), quiet — без прогресса
+PROGRESS_MODES = ("text", "json", "quiet")
+PROGRESS_INTERVAL = 5
+# Границы корзин гистограммы задержек запросов, секунды
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+# Сколько живут сырые ответы в кэше, секунды
+CACHE_TTLS = {
+    "product": 7 * 86400,
+    "recommendations": 14 * 86400,
+    "ugc": 90 * 86400,
+}
+# Сколько ответ необязательного эндпоинта из кэша считается свежим: свежий берётся вместо запроса.
+# UPC практически не меняется, рекомендации меняются медленно; товар (цена, наличие) загружается всегда
+CACHE_FRESH = {
+    "recommendations": 3 * 86400,
+    "ugc": 30 * 86400,
+}
+# Сколько записей (товар, эндпоинт) держит кэш; лишние вытесняются по давности последнего использования
+CACHE_MAX_ENTRIES = 300_000
+# Как часто движок на потоках проверяет новые ссылки, пока ждёт завершения задач, секунды
+FEED_POLL_INTERVAL = 0.05
+# Лимиты запросов на хост: rate — запросов в секунду, burst — сколько можно сделать разом
+RATE_LIMITS = {
+    "catalog.app.iherb.com": {"rate": 20.0, "burst": 20},
+    "www.iherb.com": {"rate": 10.0, "burst": 10},
+}
 os.makedirs("results", exist_ok=True)
 
 # === Вспомогательные функции ===
@@ -23,172 +112,1605 @@ def get_random_user_agent():
     return random.choice(user_agents)
 
 
+# === JSON ===
+# Разбор ответов API и запись результатов идут через эти функции: если установлен orjson,
+# используется он, иначе стандартный json. Вывод у обоих одинаковый: компактный, без экранирования
+# не-ASCII, а с indent — отступ в 2 пробела, как у json.dump(..., indent=2).
+def json_loads(data):
+    """Разбираем JSON из bytes или str; ошибки — ValueError, как у json.loads"""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # BOM, NaN и т.п. orjson не принимает: пусть решает стандартный json
+    return json.loads(data)
+
+
+def _orjson_dumps(obj, indent):
+    """bytes от orjson или None, если orjson нет или он не умеет такой объект"""
+    if orjson is None:
+        return None
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    except TypeError:
+        return None  # нестроковые ключи, целые больше 64 бит и т.п.
+
+
+def _json_dumps_std(obj, indent):
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def json_dumps(obj, indent=False):
+    encoded = _orjson_dumps(obj, indent)
+    return encoded.decode("utf-8") if encoded is not None else _json_dumps_std(obj, indent)
+
+
+def json_dumps_bytes(obj, indent=False):
+    encoded = _orjson_dumps(obj, indent)
+    return encoded if encoded is not None else _json_dumps_std(obj, indent).encode("utf-8")
+
+
+# === Ограничение частоты запросов ===
+class TokenBucket:
+    """Токен-бакет, общий для всех потоков и корутин"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Забираем токен (можно в долг) и возвращаем, сколько секунд ждать его появления"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class HostRateLimiter:
+    """Отдельный токен-бакет на каждый хост; хосты без лимита не ограничиваются"""
+
+    def __init__(self, limits):
+        self.configure(limits)
+
+    def configure(self, limits):
+        self.buckets = {
+            host: TokenBucket(limit["rate"], limit.get("burst", limit["rate"]))
+            for host, limit in limits.items()
+            if limit["rate"] > 0
+        }
+
+    def _delay(self, url):
+        bucket = self.buckets.get(urlsplit(url).hostname)
+        return bucket.reserve() if bucket else 0.0
+
+    def acquire(self, url):
+        delay = self._delay(url)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, url):
+        delay = self._delay(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+RATE_LIMITER = HostRateLimiter(RATE_LIMITS)
+
+
+# === Ошибки и повторы ===
+THROTTLE_STATUSES = {403, 429, 503}
+RETRY_STATUSES = THROTTLE_STATUSES | {408, 500, 502, 504}
+CHALLENGE_MARKERS = ("cf-chl", "challenge-platform", "Just a moment...")
+
+
+class FetchError(Exception):
+    """Классифицированная ошибка запроса; kind: timeout, network, http, json, challenge"""
+
+    def __init__(self, kind, message, status=None):
+        super().__init__(message)
+        self.kind = kind
+        self.status = status
+        self.attempts = 1
+
+    @property
+    def transient(self):
+        if self.kind == "http":
+            return self.status in RETRY_STATUSES
+        return self.kind in ("timeout", "network", "challenge")
+
+
+class ThrottledError(FetchError):
+    """Сайт нас притормаживает: 403/429/503 или страница проверки Cloudflare"""
+
+
+def check_response(status, content_type, body_head=""):
+    if "html" in content_type and any(marker in body_head for marker in CHALLENGE_MARKERS):
+        raise ThrottledError("challenge", "страница проверки Cloudflare", status)
+    if status in THROTTLE_STATUSES:
+        raise ThrottledError("http", f"HTTP {status}", status)
+    if status >= 400:
+        raise FetchError("http", f"HTTP {status}", status)
+
+
+class RetryPolicy:
+    """Повторы временных ошибок: экспоненциальная задержка с полным джиттером"""
+
+    def __init__(self, retries=3, base_delay=1.0, max_delay=30.0):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def should_retry(self, error, attempt):
+        return error.transient and attempt < self.retries
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+def retry_delay(error, attempt, url, controller=None):
+    """Окончательную ошибку попытки attempt пробрасываем, для временной считаем повтор и отдаём паузу"""
+    error.attempts = attempt + 1
+    if isinstance(error, ThrottledError) and controller is not None:
+        controller.on_throttle()
+    if not RETRY_POLICY.should_retry(error, attempt):
+        raise error
+    METRICS.count_retry(url)
+    return RETRY_POLICY.delay(attempt)
+
+
+def call_with_retry(call, url, controller=None):
+    """call() с повторами временных ошибок по RETRY_POLICY; после проверки Cloudflare обновляем куки"""
+    attempt = 0
+    while True:
+        generation = CLEARANCE_STORE.generation
+        try:
+            return call()
+        except FetchError as e:
+            delay = retry_delay(e, attempt, url, controller)
+            if e.kind == "challenge":
+                CLEARANCE_STORE.refresh(generation, url)
+            time.sleep(delay)
+            attempt += 1
+
+
+def get_checked(scraper, url, headers, read, timeout=20, stream=False):
+    """Один запрос через scraper под лимитом частоты и в метриках; read(response) проверяет и разбирает ответ.
+
+    Ошибки сети и ответа (в том числе из read) становятся FetchError/ThrottledError.
+    """
+    RATE_LIMITER.acquire(url)
+    with METRICS.track(url):
+        try:
+            response = scraper.get(url, headers=CLEARANCE_STORE.headers(headers), timeout=timeout, stream=stream)
+        except requests.exceptions.Timeout as e:
+            raise FetchError("timeout", str(e)) from e
+        except cloudscraper.exceptions.CloudflareException as e:
+            raise ThrottledError("challenge", str(e)) from e
+        except requests.exceptions.RequestException as e:
+            raise FetchError("network", str(e)) from e
+        return read(response)
+
+
+def decode_json_response(status, content_type, body):
+    """Проверяем ответ API и разбираем JSON; тип содержимого не требуем — API иногда отдаёт JSON с text/plain"""
+    body_head = body[:2048].decode("utf-8", "replace") if "html" in content_type else ""
+    check_response(status, content_type, body_head)
+    try:
+        return json_loads(body)
+    except ValueError as e:
+        raise FetchError("json", f"некорректный JSON: {e}", status) from e
+
+
+class DeadLetter:
+    """JSONL-файл товаров, которые не удалось загрузить и после всех повторов.
+
+    verbose — печатать строку на каждый товар; при --progress json/quiet её нет, иначе при
+    волне 429 она заливает логи (число ошибок и так есть в сводке прогресса и метриках).
+    """
+
+    def __init__(self, filename, verbose=True):
+        self.filename = filename
+        self.verbose = verbose
+        self.count = 0
+        self.lock = threading.Lock()
+        self.file = open(filename, "w", encoding="utf-8")
+
+    def record(self, link, error):
+        entry = {
+            "id": item_id_from_link(link),
+            "link": link,
+            "kind": getattr(error, "kind", "error"),
+            "status": getattr(error, "status", None),
+            "attempts": getattr(error, "attempts", 1),
+            "error": str(error) or type(error).__name__,
+            "failed_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with self.lock:
+            self.file.write(json_dumps(entry) + "\n")
+            self.file.flush()
+            self.count += 1
+        if self.verbose:
+            print(f"❌ {entry['id']}: {entry['kind']} — {entry['error']} (попыток: {entry['attempts']})")
+
+    def close(self):
+        self.file.close()
+
+
+def read_dead_letter(filename):
+    """Ссылки из dead-letter файла прошлого запуска (без повторов, в исходном порядке)"""
+    links = {}
+    try:
+        with open(filename, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json_loads(line)
+                    links.setdefault(entry["id"], entry["link"])
+    except FileNotFoundError:
+        pass
+    return list(links.values())
+
+
+# === Проверка Cloudflare ===
+class ClearanceStore:
+    """Куки прохождения проверки Cloudflare (cf_clearance и др.), общие для всех сессий и запусков.
+
+    Все сессии cloudscraper работают с одним потокобезопасным cookie jar, поэтому проверку,
+    пройденную одним потоком, сразу используют остальные. Куки с expires и User-Agent, с которым
+    проверка пройдена (cf_clearance к нему привязан), сохраняются в файл и подхватываются
+    следующим запуском.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.jar = requests.cookies.RequestsCookieJar()
+        self.user_agent = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                saved = json_loads(f.read())
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Не удалось прочитать {self.filename}: {e}")
+            return 0
+        now = time.time()
+        cookies = [c for c in saved.get("cookies", []) if c.get("expires") and c["expires"] > now]
+        for cookie in cookies:
+            self.jar.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"],
+                         expires=cookie["expires"])
+        if cookies:
+            self.user_agent = saved.get("user_agent")
+            expires = min(cookie["expires"] for cookie in cookies)
+            print(f"🍪 Куки Cloudflare из {self.filename}: {len(cookies)}, "
+                  f"действуют до {time.strftime('%Y-%m-%d %H:%M', time.localtime(expires))}")
+        return len(cookies)
+
+    def save(self):
+        now = time.time()
+        cookies = [
+            {"name": c.name, "value": c.value, "domain": c.domain, "path": c.path, "expires": c.expires}
+            for c in list(self.jar) if c.expires and c.expires > now
+        ]
+        if not cookies:
+            return
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(json_dumps({"user_agent": self.user_agent, "saved_at": now, "cookies": cookies}, indent=True))
+        os.replace(tmp, self.filename)
+
+    def attach(self, scraper):
+        scraper.cookies = self.jar
+        return scraper
+
+    def headers(self, headers):
+        """User-Agent запроса должен совпадать с тем, с которым пройдена проверка"""
+        if self.user_agent is None:
+            return headers
+        return {**headers, "User-Agent": self.user_agent}
+
+    def cookie_dict(self):
+        return {c.name: c.value for c in list(self.jar)}
+
+    def refresh(self, seen_generation, url=WWW_BASE_URL):
+        """Проходим проверку заново на том хосте, который её показал (url — адрес запроса).
+
+        Пока один поток решает проверку, остальные ждут на блокировке; если за это время
+        поколение сменилось, значит, проверку уже прошли, и решать её ещё раз не нужно.
+        Решает её только эта сессия: рабочие (create_scraper) проверку сами не проходят.
+        """
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}/"
+        with self.lock:
+            if self.generation != seen_generation:
+                return
+            print(f"🛡️ Проходим проверку Cloudflare ({parts.netloc})...")
+            scraper = self.attach(cloudscraper.create_scraper())
+            try:
+                scraper.get(origin, timeout=60)
+                self.user_agent = scraper.headers.get("User-Agent")
+                self.save()
+            except Exception as e:
+                print(f"⚠️ Не удалось пройти проверку Cloudflare: {e}")
+            finally:
+                scraper.close()
+                # Поколение меняется и после неудачи: ожидавшие потоки не решают проверку по очереди
+                self.generation += 1
+
+
+CLEARANCE_STORE = ClearanceStore(CLEARANCE_FILE)
+
+
+def create_scraper():
+    """Сессия cloudscraper с общими куками прохождения проверки.
+
+    Сама проверку не решает (disableCloudflareV1): иначе её решал бы каждый поток, получивший
+    заглушку. Заглушка становится ThrottledError("challenge"), и проверку проходит один поток
+    в CLEARANCE_STORE.refresh.
+    """
+    return CLEARANCE_STORE.attach(cloudscraper.create_scraper(disableCloudflareV1=True))
+
+
+# === Адаптивный параллелизм ===
+class AdaptiveConcurrency:
+    """AIMD-регулятор числа товаров в работе.
+
+    После каждых `limit` завершённых товаров лимит растёт на 1, если средняя задержка
+    не выше target_latency и доля ошибок не выше max_error_rate. Любой сигнал троттлинга
+    умножает лимит на decrease (не чаще раза в cooldown секунд).
+    """
+
+    def __init__(self, initial, minimum=1, maximum=40, target_latency=3.0,
+                 max_error_rate=0.05, decrease=0.5, cooldown=5.0):
+        # Нижняя граница не меньше 1 (при 0 лимит, упав до нуля, уже не вырастет) и не выше потолка
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = max(self.minimum, min(initial, self.maximum))
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.last_decrease = 0.0
+        self._reset_window()
+
+    def _reset_window(self):
+        self.completed = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+
+    def _set_limit(self, limit, reason):
+        old, self.limit = self.limit, limit
+        self._reset_window()
+        print(f"⚙️ Лимит параллелизма: {old} → {limit} ({reason})")
+
+    def on_success(self, latency):
+        with self.lock:
+            self.completed += 1
+            self.latency_sum += latency
+            self._maybe_grow()
+
+    def on_error(self):
+        with self.lock:
+            self.completed += 1
+            self.errors += 1
+            self._maybe_grow()
+
+    def on_throttle(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_decrease < self.cooldown:
+                return
+            self.last_decrease = now
+            limit = max(self.minimum, int(self.limit * self.decrease))
+            if limit != self.limit:
+                self._set_limit(limit, "троттлинг")
+            else:
+                self._reset_window()
+
+    def _maybe_grow(self):
+        if self.completed < self.limit:
+            return
+        successes = self.completed - self.errors
+        avg_latency = self.latency_sum / successes if successes else float("inf")
+        error_rate = self.errors / self.completed
+        if self.limit < self.maximum and avg_latency <= self.target_latency and error_rate <= self.max_error_rate:
+            self._set_limit(self.limit + 1, f"задержка {avg_latency:.2f} с, ошибок {error_rate:.0%}")
+        else:
+            self._reset_window()
+
+
+def report_item_outcome(controller, started, ok):
+    """Сообщаем регулятору, чем закончилась загрузка товара (троттлинг сообщается при каждом запросе)"""
+    METRICS.count_item(ok)
+    if controller is None:
+        return
+    if ok:
+        controller.on_success(time.monotonic() - started)
+    else:
+        controller.on_error()
+
+
+def rate_limit_spec(spec):
+    """Разбираем значение --rate вида host=rps или host=rps:burst"""
+    host, _, value = spec.partition("=")
+    rate, _, burst = value.partition(":")
+    try:
+        return host, {"rate": float(rate), "burst": float(burst) if burst else float(rate)}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"неверный лимит: {spec} (ожидается host=rps[:burst])")
+
+
+# === Метрики ===
+def endpoint_of(url):
+    """Имя эндпоинта по URL запроса, для меток метрик"""
+    if "/recommendations/" in url:
+        return "recommendations"
+    if "/ugc/" in url:
+        return "ugc"
+    if "/product/" in url:
+        return "product"
+    if "/c/" in url:
+        return "listing"
+    return "other"
+
+
+def status_class_of(error):
+    """Класс ответа: 2xx/4xx/5xx по HTTP-статусу, а для ошибок без статуса — их вид (timeout, network, ...)"""
+    if error is None:
+        return "2xx"
+    kind = getattr(error, "kind", "error")
+    if kind == "http" and error.status:
+        return f"{error.status // 100}xx"
+    return kind
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля: верхняя граница корзины, в которую он попадает"""
+        if not self.count:
+            return 0.0
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            if cumulative >= q * self.count:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Счётчики и гистограммы обхода: запросы по эндпоинтам и классам ответа, повторы, товары, очередь"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = collections.Counter()    # (эндпоинт, класс ответа) -> запросов
+        self.latency = collections.defaultdict(Histogram)    # эндпоинт -> задержки запросов
+        self.retries = collections.Counter()    # эндпоинт -> повторов
+        self.items = collections.Counter()    # ok / failed -> товаров
+        self.cache_hits = collections.Counter()    # эндпоинт -> ответов, взятых из кэша вместо запроса
+        self.in_flight = 0
+        self.items_per_second = 0.0
+        self.links_seen = 0
+        self.links_total = None
+
+    @contextlib.contextmanager
+    def track(self, url):
+        """Замеряем один запрос; ошибка пробрасывается дальше, но попадает в свой класс ответа"""
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self._observe_request(url, status_class_of(e), time.monotonic() - started)
+            raise
+        self._observe_request(url, "2xx", time.monotonic() - started)
+
+    def _observe_request(self, url, status_class, elapsed):
+        endpoint = endpoint_of(url)
+        with self.lock:
+            self.requests[endpoint, status_class] += 1
+            self.latency[endpoint].observe(elapsed)
+
+    def count_retry(self, url):
+        with self.lock:
+            self.retries[endpoint_of(url)] += 1
+
+    def count_item(self, ok):
+        with self.lock:
+            self.items["ok" if ok else "failed"] += 1
+
+    def count_degraded(self):
+        """Товар загружен, но без части необязательных эндпоинтов"""
+        with self.lock:
+            self.items["degraded"] += 1
+
+    def count_cache_hit(self, endpoint):
+        with self.lock:
+            self.cache_hits[endpoint] += 1
+
+    def set_in_flight(self, value):
+        self.in_flight = value
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        with self.lock:
+            requests_made = sorted(self.requests.items())
+            latency = {endpoint: (list(h.counts), h.sum, h.count) for endpoint, h in sorted(self.latency.items())}
+            retries = sorted(self.retries.items())
+            items = dict(self.items)
+            cache_hits = sorted(self.cache_hits.items())
+        lines = [
+            "# HELP iherb_requests_total Запросы к API по эндпоинтам и классам ответа",
+            "# TYPE iherb_requests_total counter",
+        ]
+        for (endpoint, status_class), count in requests_made:
+            lines.append(f'iherb_requests_total{{endpoint="{endpoint}",status_class="{status_class}"}} {count}')
+        lines += [
+            "# HELP iherb_request_duration_seconds Задержка запроса к API",
+            "# TYPE iherb_request_duration_seconds histogram",
+        ]
+        for endpoint, (counts, total, count) in latency.items():
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else bound
+                lines.append(f'iherb_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}')
+            lines.append(f'iherb_request_duration_seconds_sum{{endpoint="{endpoint}"}} {total:.6f}')
+            lines.append(f'iherb_request_duration_seconds_count{{endpoint="{endpoint}"}} {count}')
+        lines += ["# HELP iherb_retries_total Повторы временных ошибок", "# TYPE iherb_retries_total counter"]
+        for endpoint, count in retries:
+            lines.append(f'iherb_retries_total{{endpoint="{endpoint}"}} {count}')
+        lines += [
+            "# HELP iherb_cache_hits_total Ответы необязательных эндпоинтов, взятые из кэша вместо запроса",
+            "# TYPE iherb_cache_hits_total counter",
+        ]
+        for endpoint, count in cache_hits:
+            lines.append(f'iherb_cache_hits_total{{endpoint="{endpoint}"}} {count}')
+        lines += ["# HELP iherb_items_total Обработанные товары", "# TYPE iherb_items_total counter"]
+        for result in ("ok", "failed"):
+            lines.append(f'iherb_items_total{{result="{result}"}} {items.get(result, 0)}')
+        lines += [
+            "# HELP iherb_items_degraded_total Товары, загруженные без части необязательных эндпоинтов",
+            "# TYPE iherb_items_degraded_total counter",
+            f"iherb_items_degraded_total {items.get('degraded', 0)}",
+        ]
+        lines += [
+            "# HELP iherb_items_per_second Скорость загрузки товаров за последний интервал",
+            "# TYPE iherb_items_per_second gauge",
+            f"iherb_items_per_second {self.items_per_second:.3f}",
+            "# HELP iherb_in_flight Товаров в работе (глубина очереди загрузки)",
+            "# TYPE iherb_in_flight gauge",
+            f"iherb_in_flight {self.in_flight}",
+            "# HELP iherb_crawl_start_time_seconds Время начала обхода",
+            "# TYPE iherb_crawl_start_time_seconds gauge",
+            f"iherb_crawl_start_time_seconds {self.started:.0f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Итоги для конца запуска"""
+        with self.lock:
+            elapsed = time.time() - self.started
+            print("📈 Запросы по эндпоинтам:")
+            for endpoint, histogram in sorted(self.latency.items()):
+                classes = ", ".join(
+                    f"{status_class}: {count}"
+                    for (name, status_class), count in sorted(self.requests.items()) if name == endpoint
+                )
+                print(f"   {endpoint}: {histogram.count} ({classes}), повторов {self.retries[endpoint]}, "
+                      f"p50 ≤ {histogram.quantile(0.5)} с, p95 ≤ {histogram.quantile(0.95)} с")
+            if self.cache_hits:
+                hits = ", ".join(f"{endpoint}: {count}" for endpoint, count in sorted(self.cache_hits.items()))
+                print(f"   из кэша без запроса: {hits}")
+            done = self.items["ok"] + self.items["failed"]
+            print(f"   товаров: {self.items['ok']} загружено (неполных {self.items['degraded']}), "
+                  f"{self.items['failed']} с ошибкой, "
+                  f"{done / elapsed if elapsed else 0:.1f} товаров/с в среднем")
+
+
+METRICS = Metrics()
+
+
+class MetricsExporter:
+    """Фоновый поток: раз в interval секунд переписываем textfile для node_exporter (textfile collector)"""
+
+    def __init__(self, metrics, filename, interval=METRICS_INTERVAL):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.last_items = 0
+        self.last_time = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="iherb-metrics", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        now = time.monotonic()
+        # degraded уже входят в ok, поэтому не сумма всех счётчиков
+        items = self.metrics.items["ok"] + self.metrics.items["failed"]
+        if now > self.last_time:
+            self.metrics.items_per_second = (items - self.last_items) / (now - self.last_time)
+        self.last_items, self.last_time = items, now
+        # Пишем во временный файл и переименовываем, чтобы сборщик не прочитал файл наполовину
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.metrics.render())
+        os.replace(tmp, self.filename)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.write()
+
+
+class ProgressReporter:
+    """Один фоновый поток раз в interval секунд печатает сводку: готово/ошибок/всего, скорость и ETA.
+
+    Заменяет строку на каждый товар: при десятках потоков она упиралась в блокировку stdout
+    и засоряла логи.
+    """
+
+    def __init__(self, metrics, mode="text", interval=PROGRESS_INTERVAL):
+        self.metrics = metrics
+        self.mode = mode
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_done = 0
+        self.last_time = self.started
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="iherb-progress", daemon=True)
+
+    def start(self):
+        if self.mode != "quiet":
+            self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def snapshot(self):
+        metrics = self.metrics
+        now = time.monotonic()
+        ok, failed, degraded = metrics.items["ok"], metrics.items["failed"], metrics.items["degraded"]
+        done = ok + failed
+        rate = (done - self.last_done) / (now - self.last_time) if now > self.last_time else 0.0
+        self.last_done, self.last_time = done, now
+        total = metrics.links_total
+        eta = (total - done) / rate if total is not None and rate > 0 else None
+        return {
+            "done": done, "failed": failed, "degraded": degraded, "total": total,
+            "in_flight": metrics.in_flight, "rate": round(rate, 2),
+            "eta_seconds": round(eta) if eta is not None else None,
+            "elapsed_seconds": round(now - self.started),
+        }
+
+    def report(self):
+        state = self.snapshot()
+        if self.mode == "json":
+            print(json_dumps({"event": "progress", "time": time.strftime("%Y-%m-%dT%H:%M:%S"), **state}), flush=True)
+            return
+        # Пока ссылки ещё приходят из sitemap, всего — это «не меньше, чем найдено»
+        total = state["total"] if state["total"] is not None else f"≥{self.metrics.links_seen}"
+        eta = time.strftime("%H:%M:%S", time.gmtime(state["eta_seconds"])) if state["eta_seconds"] is not None else "?"
+        print(f"⏳ {state['done']}/{total} готово, ошибок {state['failed']}, неполных {state['degraded']}, "
+              f"в работе {state['in_flight']}, {state['rate']:.1f} товаров/с, осталось ~{eta}", flush=True)
+
+    def stop(self):
+        if self.mode == "quiet":
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.report()
+
+
+# === Sitemap ===
+def _iter_xml_entries(chunks, tag):
+    """Потоково разбираем XML из кусков байтов и отдаём (loc, lastmod) каждого элемента tag.
+
+    Разобранные элементы сразу удаляются из дерева, поэтому память не растёт с размером файла.
+    """
+    parser = lxml.etree.XMLPullParser(events=("end",), tag=f"{{*}}{tag}", recover=True, huge_tree=True)
+
+    def read_events():
+        for _, elem in parser.read_events():
+            loc = lastmod = None
+            for child in elem:
+                name = lxml.etree.QName(child).localname
+                if name == "loc":
+                    loc = (child.text or "").strip()
+                elif name == "lastmod":
+                    lastmod = (child.text or "").strip() or None
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            if loc:
+                yield loc, lastmod
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from read_events()
+    parser.close()
+    yield from read_events()
+
+
+def _open_sitemap(response):
+    # На месте sitemap HTML приходит только как страница проверки Cloudflare или ошибки сайта;
+    # разбор с recover=True молча не нашёл бы в ней ни одной ссылки
+    content_type = response.headers.get("Content-Type", "")
+    try:
+        body_head = response.text[:2048] if "html" in content_type else ""
+        check_response(response.status_code, content_type, body_head)
+        if body_head:
+            raise FetchError("http", "вместо sitemap пришла HTML-страница", response.status_code)
+    except BaseException:
+        response.close()
+        raise
+    return response
+
+
+def _sitemap_chunks(response, gzipped):
+    """Куски XML из потока ответа; обрыв соединения или архива посреди файла становится FetchError"""
+    try:
+        chunks = response.iter_content(chunk_size=64 * 1024)
+        if not gzipped:
+            yield from chunks
+            return
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+        if not decompressor.eof:
+            raise FetchError("network", "архив sitemap оборван")
+    except requests.exceptions.RequestException as e:
+        raise FetchError("network", f"обрыв загрузки: {e}") from e
+    except zlib.error as e:
+        raise FetchError("network", f"повреждённый архив sitemap: {e}") from e
+
+
+def _stream_sitemap(scraper, url, tag):
+    """Скачиваем sitemap (в т.ч. .xml.gz) и разбираем его по мере загрузки.
+
+    Открытие файла повторяется по RETRY_POLICY, как запросы товаров. После обрыва посреди файла
+    он читается заново: уже отданные ссылки отсеивает дедупликация у вызывающего.
+    """
+    headers = {"User-Agent": get_random_user_agent()}
+    attempt = 0
+    while True:
+        response = call_with_retry(
+            lambda: get_checked(scraper, url, headers, _open_sitemap, timeout=60, stream=True), url)
+        try:
+            yield from _iter_xml_entries(_sitemap_chunks(response, url.endswith(".gz")), tag)
+            return
+        except FetchError as e:
+            delay = retry_delay(e, attempt, url)
+        finally:
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def get_product_sitemaps(scraper):
+    """Список sitemap-файлов товаров из индекса.
+
+    Если индекс не прочитать и после повторов, запуск падает: с одним SITEMAP_URL вместо
+    всех файлов результаты перезаписались бы неполным каталогом.
+    """
+    print("📥 Загружаем индекс sitemap iHerb...")
+    sitemaps = list(dict.fromkeys(
+        loc for loc, _ in _stream_sitemap(scraper, SITEMAP_INDEX_URL, "sitemap")
+        if PRODUCT_SITEMAP_PATTERN.search(loc)
+    ))
+    if not sitemaps:
+        raise FetchError("http", f"в индексе {SITEMAP_INDEX_URL} нет товарных sitemap")
+    print(f"🗺️ Товарных sitemap: {len(sitemaps)}")
+    return sitemaps
+
+
+def _iter_entries_parallel(sources, produce, workers, label):
+    """Обходим источники в workers потоках и отдаём их (ссылка, lastmod) без повторов ID.
+
+    produce(source) — генератор записей одного источника. Записи отдаются по мере получения,
+    поэтому загрузка товаров начинается до того, как обработан последний источник.
+    """
+    entries = queue.Queue(maxsize=10000)
+    stop = threading.Event()
+    sources_iter = iter(sources)
+    sources_lock = threading.Lock()
+    finished = object()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                entries.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        while not stop.is_set():
+            with sources_lock:
+                source = next(sources_iter, None)
+            if source is None:
+                break
+            try:
+                for entry in produce(source):
+                    if not put(entry):
+                        return
+            except Exception as e:
+                # Источник, не загруженный и после повторов, — это дыра в каталоге: останавливаем обход
+                print(f"❌ Ошибка при загрузке {label} {source}: {e}")
+                errors.append(e)
+                stop.set()
+                break
+        put(finished)
+
+    threads = [threading.Thread(target=worker, name=f"iherb-{label}", daemon=True)
+               for _ in range(max(1, min(workers, len(sources))))]
+    for thread in threads:
+        thread.start()
+
+    seen = set()
+    running = len(threads)
+    try:
+        while running:
+            if errors:
+                raise errors[0]
+            try:
+                entry = entries.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if entry is finished:
+                running -= 1
+                continue
+            item_id = item_id_from_link(entry[0])
+            if item_id in seen:
+                continue
+            seen.add(item_id)
+            yield entry
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+
+
+def iter_sitemap_entries(workers=SITEMAP_WORKERS, sitemaps=None):
+    """Генератор (ссылка, lastmod) по всем товарным sitemap.
+
+    Файлы скачиваются параллельно в workers потоков, ссылки отдаются по мере разбора,
+    поэтому загрузка товаров начинается до того, как скачан последний sitemap.
+    sitemaps — уже прочитанный список файлов; без него сначала читаем индекс.
+    """
+    scraper = create_scraper()
+    if sitemaps is None:
+        sitemaps = get_product_sitemaps(scraper)
+
+    found = 0
+    for entry in _iter_entries_parallel(sitemaps, lambda url: _stream_sitemap(scraper, url, "url"),
+                                        workers, "sitemap"):
+        found += 1
+        yield entry
+    print(f"✅ Найдено {found} ссылок на товары.")
+
+
 def get_pages():
-    """Загружаем sitemap и извлекаем все ссылки товаров"""
-    print("📥 Загружаем sitemap iHerb...")
-    scraper = cloudscraper.create_scraper()
+    """Генератор ссылок на товары из всех товарных sitemap"""
+    for link, _ in iter_sitemap_entries():
+        yield link
+
+
+# === Категории ===
+PRODUCT_LINK_RE = re.compile(r'href="([^"]*/pr/[^"?#]+/(\d+))"')
+
+
+def cid_list(spec):
+    """Разбираем значение --cids: ID категорий через запятую"""
     try:
-        response = scraper.get(SITEMAP_URL, timeout=30)
-        response.raise_for_status()
-        tree = lxml.html.fromstring(response.content)
-        links = tree.xpath("//loc/text()")
-        print(f"✅ Найдено {len(links)} ссылок на товары.")
-        return links
-    except Exception as e:
-        print(f"❌ Ошибка при загрузке sitemap: {e}")
-        return []
+        return tuple(int(cid) for cid in spec.split(",") if cid.strip())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"неверный список категорий: {spec} (ожидается 101072,1694,...)")
+
+
+def _read_listing(response):
+    # Обычные страницы сайта тоже содержат скрипты challenge-platform,
+    # поэтому проверку узнаём только по заглушке без товаров. Заглушка приходит с 403/503,
+    # так что ищем её до проверки статуса — иначе это была бы просто ошибка http
+    text = response.text
+    if "Just a moment..." in text and "/pr/" not in text:
+        raise ThrottledError("challenge", "страница проверки Cloudflare", response.status_code)
+    check_response(response.status_code, "")
+    return text
+
+
+def _get_listing_page(scraper, url):
+    """HTML страницы листинга с повторами временных ошибок по RETRY_POLICY"""
+    headers = {"User-Agent": get_random_user_agent()}
+    return call_with_retry(lambda: get_checked(scraper, url, headers, _read_listing, timeout=30), url)
+
+
+def iter_category_links(scraper, cid):
+    """Ссылки на товары одной категории: листаем страницы, пока они приносят новые товары"""
+    seen = set()
+    for page in range(1, CATEGORY_MAX_PAGES + 1):
+        html = _get_listing_page(scraper, f"{WWW_BASE_URL}/c/supplements?cids={cid}&p={page}")
+        new_links = 0
+        for link, item_id in PRODUCT_LINK_RE.findall(html):
+            if item_id in seen:
+                continue
+            seen.add(item_id)
+            new_links += 1
+            yield (f"{WWW_BASE_URL}{link}" if link.startswith("/") else link), None
+        # За последней страницей сайт отдаёт пустой листинг или ту же последнюю страницу
+        if not new_links:
+            break
+    print(f"📂 Категория {cid}: {len(seen)} товаров")
+
+
+def iter_category_entries(cids, workers=SITEMAP_WORKERS):
+    """Генератор (ссылка, None) по товарам выбранных категорий — вместо обхода всего sitemap.
+
+    lastmod в листингах нет, поэтому --incremental с категориями загружает товары заново.
+    """
+    print(f"📥 Собираем товары категорий: {', '.join(map(str, cids))}")
+    scraper = create_scraper()
+    found = 0
+    for entry in _iter_entries_parallel(cids, lambda cid: iter_category_links(scraper, cid), workers, "категории"):
+        found += 1
+        yield entry
+    print(f"✅ Найдено {found} ссылок на товары в {len(cids)} категориях.")
+
+
+# === Сессии HTTP ===
+class SessionPool:
+    """Сессии cloudscraper для потоков загрузки; с точки зрения вызывающего — объект с .get(), как сессия.
+
+    shared: одна сессия на все потоки, пул соединений urllib3 на хост размером pool_size
+    (по умолчанию в нём 10 соединений, и при 40 потоках лишние соединения закрываются после
+    каждого запроса). per-worker: своя сессия у каждого потока — requests.Session не обещает
+    потокобезопасность, а keep-alive соединение всегда остаётся за своим потоком.
+    """
+
+    def __init__(self, mode="shared", pool_size=10):
+        if mode not in SESSION_MODES:
+            raise ValueError(f"Неизвестный режим сессий: {mode}")
+        self.mode = mode
+        self.pool_size = pool_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.shared = self._create(pool_size) if mode == "shared" else None
 
+    def _create(self, pool_size):
+        scraper = create_scraper()
+        # Адаптеры cloudscraper (с его набором шифров) оставляем, меняем только размер пулов
+        for adapter in set(scraper.adapters.values()):
+            adapter.init_poolmanager(len(RATE_LIMITS) + 2, pool_size)
+        with self.lock:
+            self.sessions.append(scraper)
+        return scraper
 
-def fetch_item_json(link, scraper, total_links, index):
-    """Загружаем JSON-данные для одного товара"""
-    item_id = link.strip().split("/")[-1]
+    def session(self):
+        if self.shared is not None:
+            return self.shared
+        scraper = getattr(self.local, "scraper", None)
+        if scraper is None:
+            scraper = self.local.scraper = self._create(1)
+        return scraper
+
+    def get(self, url, **kwargs):
+        return self.session().get(url, **kwargs)
+
+    def connection_stats(self):
+        """(запросов, новых соединений) по пулам urllib3 всех сессий"""
+        requests_made = new_connections = 0
+        with self.lock:
+            sessions = list(self.sessions)
+        for scraper in sessions:
+            for adapter in set(scraper.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        requests_made += pool.num_requests
+                        new_connections += pool.num_connections
+        return requests_made, new_connections
+
+    def close(self):
+        with self.lock:
+            for scraper in self.sessions:
+                scraper.close()
+
+
+def connection_trace_config(stats):
+    """Трассировка aiohttp: считаем запросы и новые соединения в stats (ключи requests, connections)"""
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        stats["requests"] += 1
+
+    async def on_connection_create_end(session, context, params):
+        stats["connections"] += 1
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+def report_connections(requests_made, new_connections):
+    if not requests_made:
+        return
+    reused = max(0, requests_made - new_connections)
+    print(f"🔌 Запросов: {requests_made}, новых соединений: {new_connections}, "
+          f"через keep-alive: {reused} ({reused / requests_made:.0%})")
+
+
+def item_id_from_link(link):
+    return link.strip().split("/")[-1]
+
+
+def item_urls(item_id, endpoints=None):
+    """URL основного эндпоинта товара и необязательных (рекомендации, UGC); endpoints — какие из них нужны"""
+    product_url = f"{CATALOG_BASE_URL}/product/{item_id}"
+    optional_urls = {
+        "recommendations": (
+            f"{CATALOG_BASE_URL}/recommendations/freqpurchasedtogether?productId={item_id}&pageSize=2&page=1"
+        ),
+        "ugc": f"{WWW_BASE_URL}/ugc/api/product/{item_id}",
+    }
+    if endpoints is not None:
+        optional_urls = {name: url for name, url in optional_urls.items() if name in endpoints}
+    return product_url, optional_urls
+
+
+def cached_optional_data(cache, item_id, optional_urls):
+    """Делим необязательные эндпоинты на свежие в кэше и те, что надо загрузить: (ответы из кэша, URL)"""
+    if cache is None:
+        return {}, optional_urls
+    cached = cache.lookup_fresh(item_id, optional_urls)
+    for name in cached:
+        METRICS.count_cache_hit(name)
+    return cached, {name: url for name, url in optional_urls.items() if name not in cached}
+
+
+def fetch_item_json(link, scraper, side_executor=None, controller=None, cache=None, endpoints=None):
+    """Загружаем JSON-данные для одного товара; при неудаче основного запроса — FetchError"""
+    item_id = item_id_from_link(link)
     if not item_id:
         return None
+    started = time.monotonic()
+    product_url, optional_urls = item_urls(item_id, endpoints)
+    cached, optional_urls = cached_optional_data(cache, item_id, optional_urls)
 
-    product_url = f"https://catalog.app.iherb.com/product/{item_id}"
-    recommendations_url = (
-        f"https://catalog.app.iherb.com/recommendations/freqpurchasedtogether?productId={item_id}&pageSize=2&page=1"
-    )
-    ugc_url = f"https://www.iherb.com/ugc/api/product/{item_id}"
+    headers = {"User-Agent": get_random_user_agent()}
+    # ID известен из ссылки, поэтому необязательные запросы идут параллельно с основным
+    if side_executor is not None:
+        optional = {
+            name: side_executor.submit(get_json_with_retry, scraper, url, headers, controller)
+            for name, url in optional_urls.items()
+        }
+    else:
+        optional = {}
 
     try:
-        headers = {"User-Agent": get_random_user_agent()}
-        product_data = scraper.get(product_url, headers=headers, timeout=20).json()
-        rec_data = scraper.get(recommendations_url, headers=headers, timeout=20).json()
-        ugc_data = scraper.get(ugc_url, headers=headers, timeout=20).json()
+        product_data = get_json_with_retry(scraper, product_url, headers, controller)
+        if not isinstance(product_data, dict):
+            raise FetchError("json", "ответ не является объектом товара")
+    except Exception:
+        for future in optional.values():
+            future.cancel()
+        report_item_outcome(controller, started, False)
+        raise
 
-        if rec_data:
-            product_data["frequently_purchased_together"] = rec_data
-        if ugc_data and ugc_data.get("upcCode"):
-            product_data["upcCode"] = ugc_data["upcCode"]
+    optional_data = {}
+    for name, url in optional_urls.items():
+        try:
+            if name in optional:
+                optional_data[name] = optional[name].result()
+            else:
+                optional_data[name] = get_json_with_retry(scraper, url, headers, controller)
+        except Exception:
+            optional_data[name] = None
 
-        print(f"✅ [{index+1}/{total_links}] {item_id}")
-        time.sleep(random.uniform(0.3, 0.8))
-        return product_data
-    except Exception:
-        return None
+    report_item_outcome(controller, started, True)
+    # Ответы из кэша не сохраняем заново, иначе их время загрузки сдвигалось бы и они не устаревали
+    if cache is not None:
+        cache.put_item(item_id, product_data, optional_data)
+    optional_data.update(cached)
+    if merge_optional_data(product_data, optional_data):
+        METRICS.count_degraded()
+    return product_data
 
 
-def get_items_json_threaded_batched(links, max_workers=40, batch_size=300):
-    """Загружаем JSON данных для товаров в потоках"""
-    scraper = cloudscraper.create_scraper()
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [
-            executor.submit(fetch_item_json, link, scraper, len(links), i)
-            for i, link in enumerate(links)
-        ]
+def _read_json(response):
+    return decode_json_response(response.status_code, response.headers.get("Content-Type", ""), response.content)
+
+
+def get_json_with_retry(scraper, url, headers, controller=None):
+    """JSON эндпоинта API с повторами временных ошибок по RETRY_POLICY"""
+    return call_with_retry(lambda: get_checked(scraper, url, headers, _read_json), url, controller)
+
+
+def merge_optional_data(product_data, optional_data):
+    """Добавляем в товар данные необязательных эндпоинтов, возвращаем список неудавшихся"""
+    rec_data = optional_data.get("recommendations")
+    ugc_data = optional_data.get("ugc")
+    if rec_data:
+        product_data["frequently_purchased_together"] = rec_data
+    if isinstance(ugc_data, dict) and ugc_data.get("upcCode"):
+        product_data["upcCode"] = ugc_data["upcCode"]
+    return [name for name, data in optional_data.items() if data is None]
+
+
+def count_links(links, metrics):
+    """Считаем ссылки, отданные в загрузку; общее число известно сразу для списка или когда генератор иссяк"""
+    metrics.links_total = len(links) if hasattr(links, "__len__") else None
+    for link in links:
+        metrics.links_seen += 1
+        yield link
+    metrics.links_total = metrics.links_seen
+
+
+def _window(max_in_flight, controller):
+    """Сколько товаров можно держать в работе прямо сейчас"""
+    return max_in_flight if controller is None else min(max_in_flight, controller.limit)
+
+
+class LinkFeeder:
+    """Читаем ссылки из итератора в отдельном потоке и отдаём движку загрузки уже готовые.
+
+    Источник ссылок блокирует: ждёт sitemap и листинги категорий, ходит в SQLite-индекс.
+    Если читать его из цикла движка, на это время встают сбор готовых товаров (потоки)
+    или все запросы в event loop (asyncio). on_ready вызывается из потока чтения на каждую
+    новую ссылку и в конце — так asyncio-движок узнаёт, что ждать больше нечего.
+    """
+
+    _END = object()
+
+    def __init__(self, links, maxsize, on_ready=None):
+        self.queue = queue.Queue(maxsize=max(1, maxsize))
+        self.on_ready = on_ready
+        self.exhausted = False
+        self.closed = False
+        self.error = None
+        threading.Thread(target=self._run, args=(iter(links),), name="iherb-links", daemon=True).start()
+
+    def _run(self, links):
+        try:
+            for link in links:
+                if not self._put(link):
+                    return
+        except Exception as e:
+            self.error = e
+        self._put(self._END)
+
+    def _put(self, item):
+        # С таймаутом, чтобы после close() поток не висел на полной очереди
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            if self.on_ready is not None:
+                self.on_ready()
+            return True
+        return False
+
+    def take(self, count, block=False):
+        """До count готовых ссылок; при block ждём хотя бы одну (или конец ссылок)"""
+        taken = []
+        while len(taken) < count and not self.exhausted:
+            try:
+                link = self.queue.get(block=block and not taken)
+            except queue.Empty:
+                break
+            if link is self._END:
+                self.exhausted = True
+                if self.error is not None:
+                    raise self.error
+            else:
+                taken.append(link)
+        return taken
+
+    def close(self):
+        self.closed = True
+
+
+def get_items_json_threaded_batched(links, max_workers=40, batch_size=300, max_in_flight=None, controller=None,
+                                    on_failure=None, cache=None, session_mode="shared", endpoints=None):
+    """Загружаем JSON данных для товаров в потоках.
+
+    Ссылки берутся из итератора лениво: одновременно существует не больше max_in_flight
+    задач (или controller.limit, если задан регулятор), а результаты отдаются пакетами
+    в порядке завершения. Неудавшиеся товары передаются в on_failure(link, error).
+    """
+    if max_in_flight is None:
+        max_in_flight = max_workers * 2
+    feeder = LinkFeeder(links, max_in_flight)
+
+    # Запросы к одному хосту одновременно идут из обоих пулов потоков
+    scraper = SessionPool(session_mode, pool_size=max_workers * 3)
+    # Отдельный пул для рекомендаций и UGC: задачи из основного пула ждут их результатов,
+    # поэтому в тот же пул их отправлять нельзя (взаимная блокировка)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            ThreadPoolExecutor(max_workers=max_workers * 2) as side_executor:
+        pending = {}
         batch = []
-        for i, future in enumerate(as_completed(futures)):
-            result = future.result()
-            if result:
-                batch.append(result)
-            if (i + 1) % batch_size == 0 or (i + 1) == len(links):
-                if batch:
+        try:
+            while True:
+                room = max(0, _window(max_in_flight, controller) - len(pending))
+                # Без задач в работе ждём первую ссылку, иначе берём только уже готовые
+                for link in feeder.take(room, block=not pending):
+                    future = executor.submit(fetch_item_json, link, scraper, side_executor, controller, cache,
+                                             endpoints)
+                    pending[future] = link
+                METRICS.set_in_flight(len(pending))
+                if not pending:
+                    if feeder.exhausted:
+                        break
+                    continue
+
+                # Пока в окне есть место, просыпаемся и ради новых ссылок, а не только по завершении задач
+                timeout = FEED_POLL_INTERVAL if room and not feeder.exhausted else None
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    link = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if on_failure is not None:
+                            on_failure(link, e)
+                        continue
+                    if result:
+                        batch.append(result)
+                if len(batch) >= batch_size:
                     yield batch
                     batch = []
+        finally:
+            feeder.close()
+        if batch:
+            yield batch
+    report_connections(*scraper.connection_stats())
+    scraper.close()
+
+
+async def fetch_item_json_async(link, session, semaphore, controller=None, cache=None, endpoints=None):
+    """Асинхронный аналог fetch_item_json: один товар под общим семафором"""
+    item_id = item_id_from_link(link)
+    if not item_id:
+        return None
+    product_url, optional_urls = item_urls(item_id, endpoints)
+    # Кэш — это gzip, файлы и SQLite под общей блокировкой, поэтому не в event loop
+    loop = asyncio.get_running_loop()
+    cached = {}
+    if cache is not None:
+        cached, optional_urls = await loop.run_in_executor(None, cached_optional_data, cache, item_id, optional_urls)
+
+    async with semaphore:
+        started = time.monotonic()
+        headers = {"User-Agent": get_random_user_agent()}
+        results = await asyncio.gather(
+            get_json_with_retry_async(session, product_url, headers, controller),
+            *(get_json_with_retry_async(session, url, headers, controller) for url in optional_urls.values()),
+            return_exceptions=True,
+        )
+        product_data, optional_results = results[0], results[1:]
+        if not isinstance(product_data, dict):
+            report_item_outcome(controller, started, False)
+            if isinstance(product_data, BaseException):
+                raise product_data
+            raise FetchError("json", "ответ не является объектом товара")
+        report_item_outcome(controller, started, True)
+
+        optional_data = {
+            name: None if isinstance(data, BaseException) else data
+            for name, data in zip(optional_urls, optional_results)
+        }
+        if cache is not None:
+            await loop.run_in_executor(None, cache.put_item, item_id, product_data, optional_data)
+        optional_data.update(cached)
+        if merge_optional_data(product_data, optional_data):
+            METRICS.count_degraded()
+        return product_data
+
+
+async def _get_json_async(session, url, headers):
+    await RATE_LIMITER.acquire_async(url)
+    with METRICS.track(url):
+        try:
+            async with session.get(url, headers=CLEARANCE_STORE.headers(headers)) as response:
+                body = await response.read()
+                return decode_json_response(response.status, response.headers.get("Content-Type", ""), body)
+        except asyncio.TimeoutError as e:
+            raise FetchError("timeout", "таймаут запроса") from e
+        except aiohttp.ClientError as e:
+            raise FetchError("network", str(e)) from e
+
+
+async def get_json_with_retry_async(session, url, headers, controller=None):
+    """Асинхронный аналог get_json_with_retry (ошибки классифицирует тот же retry_delay)"""
+    attempt = 0
+    while True:
+        generation = CLEARANCE_STORE.generation
+        try:
+            return await _get_json_async(session, url, headers)
+        except FetchError as e:
+            delay = retry_delay(e, attempt, url, controller)
+            if e.kind == "challenge":
+                # Проверку решает cloudscraper (синхронно), поэтому в потоке, а куки переносим в aiohttp
+                await asyncio.get_running_loop().run_in_executor(None, CLEARANCE_STORE.refresh, generation, url)
+                session.cookie_jar.update_cookies(CLEARANCE_STORE.cookie_dict())
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def _crawl_async(links, max_workers, batch_size, max_in_flight, controller, on_failure, cache, endpoints, emit):
+    """Загружаем товары в одном event loop и отдаём пакеты через emit"""
+    semaphore = asyncio.Semaphore(max_workers)
+    # Каждый товар — до трёх одновременных запросов (товар, рекомендации, UGC)
+    connector = aiohttp.TCPConnector(limit=max_workers * 3, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=20)
+    loop = asyncio.get_running_loop()
+    stats = {"requests": 0, "connections": 0}
+    # Итератор ссылок блокирует, поэтому читаем его в потоке; loop будим при появлении ссылки
+    ready = asyncio.Event()
+    feeder = LinkFeeder(links, max_in_flight, lambda: loop.call_soon_threadsafe(ready.set))
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, cookies=CLEARANCE_STORE.cookie_dict(),
+                                     trace_configs=[connection_trace_config(stats)]) as session:
+        pending = {}
+        batch = []
+        try:
+            while True:
+                ready.clear()
+                room = max(0, _window(max_in_flight, controller) - len(pending))
+                for link in feeder.take(room):
+                    task = asyncio.create_task(
+                        fetch_item_json_async(link, session, semaphore, controller, cache, endpoints)
+                    )
+                    pending[task] = link
+                METRICS.set_in_flight(len(pending))
+                if not pending and feeder.exhausted:
+                    break
+
+                waiters = set(pending)
+                arrival = None
+                if room and not feeder.exhausted:
+                    arrival = asyncio.ensure_future(ready.wait())
+                    waiters.add(arrival)
+                done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                if arrival is not None and arrival not in done:
+                    arrival.cancel()
+                for task in done:
+                    if task is arrival:
+                        continue
+                    link = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        if on_failure is not None:
+                            on_failure(link, e)
+                        continue
+                    if result:
+                        batch.append(result)
+                if len(batch) >= batch_size:
+                    # put() блокирует, пока потребитель не заберёт пакет, поэтому не в самом loop
+                    await loop.run_in_executor(None, emit, batch)
+                    batch = []
+        finally:
+            feeder.close()
+        if batch:
+            await loop.run_in_executor(None, emit, batch)
+    report_connections(stats["requests"], stats["connections"])
+
+
+def get_items_json_async_batched(links, max_workers=500, batch_size=300, max_in_flight=None, controller=None,
+                                 on_failure=None, cache=None, endpoints=None):
+    """Загружаем JSON данных для товаров через asyncio (тот же контракт, что у потокового варианта)"""
+    if aiohttp is None:
+        raise RuntimeError("Для движка async нужен пакет aiohttp: pip install aiohttp")
+
+    if max_in_flight is None:
+        # Задачи asyncio дешёвые, а ссылки заранее читает LinkFeeder, запас сверх семафора не нужен
+        max_in_flight = max_workers
+    batches = queue.Queue(maxsize=2)
+    done = object()
+
+    def run_loop():
+        try:
+            asyncio.run(_crawl_async(
+                links, max_workers, batch_size, max_in_flight, controller, on_failure, cache, endpoints, batches.put
+            ))
+            batches.put(done)
+        except BaseException as e:
+            batches.put(e)
+
+    threading.Thread(target=run_loop, name="iherb-async", daemon=True).start()
+    while True:
+        batch = batches.get()
+        if batch is done:
+            return
+        if isinstance(batch, BaseException):
+            raise batch
+        yield batch
+
+
+def get_items_json_batched(links, engine="threads", max_workers=None, batch_size=300, max_in_flight=None,
+                           adaptive=False, min_workers=1, target_latency=3.0, on_failure=None, cache=None,
+                           session_mode="shared", endpoints=None):
+    """Выбираем движок загрузки: потоки или asyncio.
+
+    При adaptive=True max_workers — потолок, а фактический параллелизм подбирает AIMD-регулятор,
+    начиная с четверти потолка.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Неизвестный движок: {engine}")
+    if max_workers is None:
+        max_workers = DEFAULT_WORKERS[engine]
+    controller = None
+    if adaptive:
+        controller = AdaptiveConcurrency(
+            initial=max(min_workers, max_workers // 4), minimum=min_workers,
+            maximum=max_workers, target_latency=target_latency,
+        )
+        print(f"⚙️ Адаптивный параллелизм: старт {controller.limit}, диапазон {controller.minimum}..{controller.maximum}")
+    options = dict(max_workers=max_workers, batch_size=batch_size, max_in_flight=max_in_flight,
+                   controller=controller, on_failure=on_failure, cache=cache, endpoints=endpoints)
+    if engine == "async":
+        # У aiohttp один пул соединений на сессию, его размер задаёт TCPConnector
+        return get_items_json_async_batched(links, **options)
+    return get_items_json_threaded_batched(links, session_mode=session_mode, **options)
+
+
+IMAGE_URL_BASE = "https://cloudinary.images-iherb.com/image/upload/f_auto,q_auto:eco/images"
+HTML_TAG_RE = re.compile("<.*?>")
+CURRENCY_SIGNS = {"$": "USD", "€": "EUR", "£": "GBP"}
 
 
 def parse_item(item):
     """Парсим нужные поля из JSON"""
     try:
-        title = item.get("displayName", "")
-        brand = item.get("brandName", "")
-        link = item.get("url", "")
-        image_indices = item.get("imageIndices", [])
-        image_indices_360 = item.get("imageIndices360", [])
-        
-        brand_code = item.get("brandCode", "").lower() if item.get("brandCode") else ""
-        category = item.get("rootCategoryName", "")
-        category_id = item.get("rootCategoryId", "")
-        part_num = item.get("partNumber", "").lower().replace("-", "") if item.get("partNumber") else ""
-        
-        regular_image_links = []
-        if brand_code and part_num:
-            for idx in image_indices:
-                regular_image_links.append(f"https://cloudinary.images-iherb.com/image/upload/f_auto,q_auto:eco/images/{brand_code}/{part_num}/v/{idx}.jpg")
-        
-        _360_image_links = []
+        get = item.get
+        title = get("displayName", "")
+        brand = get("brandName", "")
+        link = get("url", "")
+
+        brand_code = get("brandCode")
+        brand_code = brand_code.lower() if brand_code else ""
+        category = get("rootCategoryName", "")
+        category_id = get("rootCategoryId", "")
+        part_num = get("partNumber")
+        part_num = part_num.lower().replace("-", "") if part_num else ""
+
+        # Префикс ссылок на картинки один для всех картинок товара
+        image_prefix = f"{IMAGE_URL_BASE}/{brand_code}/{part_num}/v/"
         if brand_code and part_num:
-            for idx in image_indices_360:
-                _360_image_links.append(f"https://cloudinary.images-iherb.com/image/upload/f_auto,q_auto:eco/images/{brand_code}/{part_num}/v/{idx}.jpg")
+            regular_image_links = [f"{image_prefix}{idx}.jpg" for idx in get("imageIndices", [])]
+            _360_image_links = [f"{image_prefix}{idx}.jpg" for idx in get("imageIndices360", [])]
+        else:
+            regular_image_links = []
+            _360_image_links = []
 
         # If no regular images and primaryImageIndex exists, use it as a regular image
-        if not regular_image_links and item.get("primaryImageIndex"):
-            regular_image_links.append(f'https://cloudinary.images-iherb.com/image/upload/f_auto,q_auto:eco/images/{brand_code}/{part_num}/v/{item.get("primaryImageIndex")}.jpg')
+        primary_image_index = get("primaryImageIndex")
+        if not regular_image_links and primary_image_index:
+            regular_image_links.append(f"{image_prefix}{primary_image_index}.jpg")
 
-        item_id = item.get("id", "")
-        package = item.get("packageQuantity", "")
+        item_id = get("id", "")
+        package = get("packageQuantity", "")
 
-        price_info = item.get("listPrice", {})
+        price_info = get("listPrice", {})
         if isinstance(price_info, dict):
             price = price_info.get("amount", "")
             currency = price_info.get("currencyCode", "USD")
         else:
             price_str = str(price_info)
-            price = price_str[1:] if len(price_str) > 1 and price_str[0] in ["$", "€", "£"] else price_str
-            currency = "USD" if price_str.startswith("$") else "EUR" if price_str.startswith("€") else "GBP" if price_str.startswith("£") else "USD"
+            sign = price_str[:1]
+            price = price_str[1:] if len(price_str) > 1 and sign in CURRENCY_SIGNS else price_str
+            currency = CURRENCY_SIGNS.get(sign, "USD")
 
-        availability = "Available" if bool(item.get("isAvailableToPurchase")) else "Unavailable"
-        dimensions = item.get("dimensions", "")
-        weight_info = item.get("actualWeight", {})
+        availability = "Available" if get("isAvailableToPurchase") else "Unavailable"
+        dimensions = get("dimensions", "")
+        weight_info = get("actualWeight", {})
         if isinstance(weight_info, dict):
             weight = f"{weight_info.get('amount', '')} {weight_info.get('unit', '')}".strip()
         else:
             weight = str(weight_info)
 
-        expiration_date = item.get("formattedExpirationDate", "")
-        rating = item.get("averageRating", "")
-        total_rating_count = item.get("totalRatingCount", "")
-        recent_activity_message = item.get("recentActivityMessage", "")
-        upc_code = item.get("upcCode", "")
+        expiration_date = get("formattedExpirationDate", "")
+        on_sale_date = get("formattedOnSaleDate")
+        rating = get("averageRating", "")
+        total_rating_count = get("totalRatingCount", "")
+        recent_activity_message = get("recentActivityMessage", "")
+        upc_code = get("upcCode", "")
 
-        product_rankings = []
-        if item.get("productRanks"):
-            for rank_info in item.get("productRanks"):
-                product_rankings.append(f"{rank_info.get('categoryDisplayName', '')}: {rank_info.get('rank', '')}")
+        product_ranks = get("productRanks")
+        product_rankings = [
+            f"{rank_info.get('categoryDisplayName', '')}: {rank_info.get('rank', '')}"
+            for rank_info in product_ranks
+        ] if product_ranks else []
 
         # Extracting Brand Path and Category Path
         all_brand_paths = []
         all_category_paths = []
-        canonical_paths = item.get("canonicalPaths", [])
-        for path in canonical_paths:
+        for path in get("canonicalPaths", []):
             path_display_names = [p.get("displayName", "") for p in reversed(path)]
-            path_str = " > ".join(path_display_names)
-            
-            if path_display_names and "Brands A-Z" in path_display_names[0]:
-                all_brand_paths.append(path_str)
-            elif path_display_names and "Categories" in path_display_names[0]:
-                all_category_paths.append(path_str)
+            if not path_display_names:
+                continue
+            root = path_display_names[0]
+            if "Brands A-Z" in root:
+                all_brand_paths.append(" > ".join(path_display_names))
+            elif "Categories" in root:
+                all_category_paths.append(" > ".join(path_display_names))
 
         # Combining Origin Product and Frequently Purchased Together products
         combined_related_products = []
-        if item.get('frequently_purchased_together') and item['frequently_purchased_together'].get('originProduct'):
-            op = item['frequently_purchased_together']['originProduct']
-            combined_related_products.append(f"Current item: {op.get('name', '')}, {op.get('listPrice', '')}")
+        together = get("frequently_purchased_together")
+        if together:
+            op = together.get("originProduct")
+            if op:
+                combined_related_products.append(f"Current item: {op.get('name', '')}, {op.get('listPrice', '')}")
+            recommended = together.get("recommendedProducts")
+            if recommended:
+                combined_related_products.extend(
+                    f"{rec_product.get('name', '')}, {rec_product.get('listPrice', '')}"
+                    for rec_product in recommended
+                )
 
-        if item.get('frequently_purchased_together') and item['frequently_purchased_together'].get('recommendedProducts'):
-            for rec_product in item['frequently_purchased_together']['recommendedProducts']:
-                combined_related_products.append(f"{rec_product.get('name', '')}, {rec_product.get('listPrice', '')}")
-
-        description = item.get("description", "")
+        description = get("description", "")
         if description:
             description = description.replace("</li>", "\n").replace("</p>", "\n").replace("<br>", "\n").replace("<br/>", "\n").replace("&nbsp;", " ")
-            clean = re.compile("<.*?>")
-            description = re.sub(clean, "", description).strip()
-
-        product_details_str = ""
-        if expiration_date: product_details_str += f"\n• Best by: {expiration_date}"
-        if item.get("formattedOnSaleDate"): product_details_str += f"\n• First available: {item.get('formattedOnSaleDate')}"
-        if weight: product_details_str += f"\n• Shipping weight: {weight}"
-        if part_num: product_details_str += f"\n• Product code: {part_num}"
-        if upc_code: product_details_str += f"\n• UPC: {upc_code}"
-        if package: product_details_str += f"\n• Package quantity: {package}"
-        if dimensions: product_details_str += f"\n• Dimensions: {dimensions}"
+            description = HTML_TAG_RE.sub("", description).strip()
+
+        details = []
+        if expiration_date: details.append(f"• Best by: {expiration_date}")
+        if on_sale_date: details.append(f"• First available: {on_sale_date}")
+        if weight: details.append(f"• Shipping weight: {weight}")
+        if part_num: details.append(f"• Product code: {part_num}")
+        if upc_code: details.append(f"• UPC: {upc_code}")
+        if package: details.append(f"• Package quantity: {package}")
+        if dimensions: details.append(f"• Dimensions: {dimensions}")
 
         if product_rankings:
-            product_details_str += "\n\nProduct rankings:"
+            details.append("\nProduct rankings:")
             for rank in product_rankings:
-                product_details_str += f"\n#{rank.split(': ')[1]} in {rank.split(': ')[0]}"
+                # Как и раньше, делим по первым двум ": " — название категории с двоеточием режется так же
+                parts = rank.split(": ")
+                details.append(f"#{parts[1]} in {parts[0]}")
 
         return {
             "Title": title or "",
@@ -198,25 +1720,291 @@ def parse_item(item):
             "Category_ID": category_id or "",
             "Price": price or "",
             "Currency": currency or "",
-            "Available": availability or "",
+            "Available": availability,
             "Rating": str(rating) if rating else "",
             "Total_Rating_Count": total_rating_count or "",
             "Recent_Activity_Message": recent_activity_message or "",
             "Product_Code_UPC": upc_code or "",
-            "Brand_Path": "; ".join(all_brand_paths) or "",
-            "Category_Path": "; ".join(all_category_paths) or "",
-            "Related_Products": "; ".join(combined_related_products) or "",
+            "Brand_Path": "; ".join(all_brand_paths),
+            "Category_Path": "; ".join(all_category_paths),
+            "Related_Products": "; ".join(combined_related_products),
             "Description": description or "",
             "Link": link or "",
-            "Images": ", ".join(regular_image_links) or "",
-            "Images_360": ", ".join(_360_image_links) or "",
-            "Product_Details": product_details_str.strip()
+            "Images": ", ".join(regular_image_links),
+            "Images_360": ", ".join(_360_image_links),
+            "Product_Details": "\n".join(details).strip()
         }
     except Exception as e:
         print(f"❌ Ошибка парсинга товара: {e}")
         return None
 
 
+# Поля записи parse_item в порядке вывода
+OUTPUT_FIELDS = (
+    "Title", "Brand", "ID", "Category", "Category_ID", "Price", "Currency", "Available", "Rating",
+    "Total_Rating_Count", "Recent_Activity_Message", "Product_Code_UPC", "Brand_Path", "Category_Path",
+    "Related_Products", "Description", "Link", "Images", "Images_360", "Product_Details",
+)
+# Поля, которым нужны необязательные эндпоинты; всё остальное parse_item берёт из ответа товара.
+# Related_Products строится из рекомендаций, UPC приходит только из UGC (и попадает в Product_Details)
+FIELD_ENDPOINTS = {
+    "Related_Products": ("recommendations",),
+    "Product_Code_UPC": ("ugc",),
+    "Product_Details": ("ugc",),
+}
+
+
+def field_list(spec):
+    """Разбираем значение --fields: поля вывода через запятую"""
+    fields = tuple(field.strip() for field in spec.split(",") if field.strip())
+    unknown = [field for field in fields if field not in OUTPUT_FIELDS]
+    if unknown or not fields:
+        raise argparse.ArgumentTypeError(
+            f"неизвестные поля: {', '.join(unknown) or spec} (доступны: {', '.join(OUTPUT_FIELDS)})"
+        )
+    return fields
+
+
+def endpoints_for_fields(fields):
+    """Необязательные эндпоинты, без которых не собрать fields; None — нужны все поля и все эндпоинты"""
+    if fields is None:
+        return None
+    return {endpoint for field in fields for endpoint in FIELD_ENDPOINTS.get(field, ())}
+
+
+def select_fields(record, fields):
+    """Оставляем в записи только fields; ID остаётся всегда — по нему работают журнал, шарды и слияние"""
+    if fields is None:
+        return record
+    return {name: record[name] for name in OUTPUT_FIELDS if name == "ID" or name in fields}
+
+
+def parse_batch(items, fields=None):
+    """Парсим пакет сырых ответов; функция верхнего уровня, чтобы её можно было отдать в процесс"""
+    parsed_batch = []
+    for item in items:
+        parsed = parse_item(item)
+        if parsed:
+            parsed_batch.append(select_fields(parsed, fields))
+    return parsed_batch
+
+
+def iter_parsed_batches(batches, parse_workers=0, fields=None):
+    """Парсим пакеты по мере поступления, сохраняя их порядок.
+
+    При parse_workers > 1 пакеты уходят в пул процессов, и разбор масштабируется по ядрам,
+    а не упирается в GIL потока, который забирает пакеты у загрузки. В работе держим не больше
+    2 x parse_workers пакетов: если пул не успевает, загрузка ждёт, а не копит пакеты в памяти.
+    """
+    if parse_workers <= 1:
+        for batch in batches:
+            yield parse_batch(batch, fields)
+        return
+    # spawn, а не fork: к этому моменту уже работают потоки загрузки и их блокировки
+    with ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.submit(parse_batch, batch, fields))
+            while pending and (pending[0].done() or len(pending) >= parse_workers * 2):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# === Запись результатов ===
+class JsonlSink:
+    """Пишем записи в JSONL по мере готовности: одна строка — один товар"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.file = open(filename, "w", encoding="utf-8")
+
+    def write_batch(self, records):
+        for record in records:
+            self.file.write(json_dumps(record))
+            self.file.write("\n")
+        self.count += len(records)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonArraySink:
+    """Потоково пишем валидный JSON-массив в том же виде, что json.dump(..., indent=2).
+
+    До close() в конце файла нет закрывающей скобки, но всё записанное уже на диске.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.file = open(filename, "w", encoding="utf-8")
+        self.file.write("[")
+
+    def write_batch(self, records):
+        for record in records:
+            self.file.write(",\n  " if self.count else "\n  ")
+            self.file.write(json_dumps(record, indent=True).replace("\n", "\n  "))
+            self.count += 1
+        self.file.flush()
+
+    def close(self):
+        self.file.write("\n]" if self.count else "]")
+        self.file.close()
+
+
+OUTPUT_FORMATS = {
+    "json": (JsonArraySink, "results/iherb.json"),
+    "jsonl": (JsonlSink, "results/iherb.jsonl"),
+}
+
+
+def open_json_sink(output_format, shard=None):
+    sink_class, filename = OUTPUT_FORMATS[output_format]
+    return sink_class(shard_path(filename, shard))
+
+
+# Типизированные колонки табличного вывода; остальные поля записи пишутся текстом
+TABLE_COLUMN_TYPES = {
+    "ID": int,
+    "Category_ID": int,
+    "Price": float,
+    "Rating": float,
+    "Total_Rating_Count": int,
+}
+SQLITE_TYPES = {int: "INTEGER", float: "REAL", str: "TEXT"}
+
+
+def table_value(value, kind):
+    """Значение поля для колонки типа kind: число или None вместо пустой строки и мусора"""
+    if kind is str:
+        return value
+    if value in ("", None):
+        return None
+    try:
+        number = float(str(value).replace(",", ""))
+    except ValueError:
+        return None
+    return int(number) if kind is int else number
+
+
+def table_columns(record):
+    """Колонки записи в порядке OUTPUT_FIELDS (при --fields запись содержит не все поля)"""
+    return tuple(name for name in OUTPUT_FIELDS if name in record)
+
+
+class SqliteSink:
+    """Пишем товары в таблицу products с upsert по ID.
+
+    Файл не пересоздаётся: каждый запуск обновляет строки своих товаров и updated_at, а при
+    --fields — только переданные колонки. Поэтому таблицу можно держать как витрину и
+    запрашивать без полной перезагрузки результатов.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(
+            f'"{name}" {SQLITE_TYPES[TABLE_COLUMN_TYPES.get(name, str)]}' for name in OUTPUT_FIELDS if name != "ID"
+        )
+        self.conn.execute(
+            f'CREATE TABLE IF NOT EXISTS products ("ID" INTEGER PRIMARY KEY, {columns}, updated_at REAL NOT NULL)'
+        )
+        self.conn.commit()
+
+    def write_batch(self, records):
+        groups = collections.defaultdict(list)
+        now = time.time()
+        for record in records:
+            columns = table_columns(record)
+            row = [table_value(record[name], TABLE_COLUMN_TYPES.get(name, str)) for name in columns]
+            # Без ID строку не к чему привязать: SQLite выдал бы ей новый rowid
+            if "ID" in columns and row[columns.index("ID")] is not None:
+                groups[columns].append(row + [now])
+        with self.conn:
+            for columns, rows in groups.items():
+                names = ", ".join(f'"{name}"' for name in columns)
+                updates = ", ".join(f'"{name}" = excluded."{name}"' for name in columns + ("updated_at",) if name != "ID")
+                self.conn.executemany(
+                    f"INSERT INTO products ({names}, updated_at) VALUES ({', '.join('?' * (len(columns) + 1))}) "
+                    f'ON CONFLICT("ID") DO UPDATE SET {updates}',
+                    rows,
+                )
+                self.count += len(rows)
+
+    def close(self):
+        self.conn.close()
+
+
+class ParquetSink:
+    """Пишем товары в Parquet: цена, рейтинг и число отзывов — числовые колонки, а не строки.
+
+    Записи копятся до PARQUET_ROW_GROUP строк и уходят на диск группой строк; схема
+    берётся по колонкам первой записи (при --fields — только выбранные поля).
+    """
+
+    PARQUET_ROW_GROUP = 10_000
+    ARROW_TYPES = {int: "int64", float: "float64", str: "string"}
+
+    def __init__(self, filename):
+        if pyarrow is None:
+            raise RuntimeError("Для вывода в Parquet нужен пакет pyarrow: pip install pyarrow")
+        self.filename = filename
+        self.count = 0
+        self.columns = None
+        self.rows = []
+        self.writer = None
+
+    def _schema(self, columns):
+        return pyarrow.schema([
+            (name, getattr(pyarrow, self.ARROW_TYPES[TABLE_COLUMN_TYPES.get(name, str)])()) for name in columns
+        ])
+
+    def _flush(self):
+        if self.columns is None:
+            self.columns = OUTPUT_FIELDS
+        schema = self._schema(self.columns)
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename, schema)
+        table = pyarrow.Table.from_pydict(
+            {name: [row[i] for row in self.rows] for i, name in enumerate(self.columns)}, schema=schema
+        )
+        self.writer.write_table(table)
+        self.rows = []
+
+    def write_batch(self, records):
+        for record in records:
+            if self.columns is None:
+                self.columns = table_columns(record)
+            self.rows.append([
+                table_value(record.get(name, ""), TABLE_COLUMN_TYPES.get(name, str)) for name in self.columns
+            ])
+        self.count += len(records)
+        if len(self.rows) >= self.PARQUET_ROW_GROUP:
+            self._flush()
+
+    def close(self):
+        if self.rows or self.writer is None:
+            self._flush()
+        self.writer.close()
+
+
+TABLE_FORMATS = {
+    "sqlite": (SqliteSink, "results/iherb.sqlite"),
+    "parquet": (ParquetSink, "results/iherb.parquet"),
+}
+
+
+def open_table_sink(table_format, shard=None):
+    sink_class, filename = TABLE_FORMATS[table_format]
+    return sink_class(shard_path(filename, shard))
+
+
+@functools.lru_cache(maxsize=None)
 def create_valid_xml_tag(name):
     """Создает валидное имя для XML тега"""
     # Заменяем все недопустимые символы на подчеркивания
@@ -230,59 +2018,58 @@ def create_valid_xml_tag(name):
     return valid_name
 
 
+# Символы, запрещённые в XML 1.0 даже в экранированном виде
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+
+def xml_text(value):
+    """Текст поля для XML: экранируем &, <, > ровно один раз и убираем запрещённые символы"""
+    if value is None:
+        return ""
+    return xml_escape(INVALID_XML_CHARS.sub("", str(value)))
+
+
+class XmlSink:
+    """Потоково пишем XML: каждый <product> сразу уходит на диск, дерево в памяти не строится"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+        self.file = open(filename, "w", encoding="utf-8")
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n<products>')
+
+    def write_batch(self, records):
+        parts = []
+        for record in records:
+            parts.append("\n  <product>")
+            for key, value in record.items():
+                tag_name = create_valid_xml_tag(key)
+                text = xml_text(value)
+                parts.append(f"\n    <{tag_name}>{text}</{tag_name}>" if text else f"\n    <{tag_name} />")
+            parts.append("\n  </product>")
+        self.file.write("".join(parts))
+        self.count += len(records)
+        self.file.flush()
+
+    def close(self):
+        self.file.write("\n</products>\n" if self.count else "</products>\n")
+        self.file.close()
+
+
 def save_to_xml(data, filename):
     """Сохраняем данные в XML формате"""
     try:
-        root = ET.Element("products")
-        
-        for item in data:
-            product_elem = ET.SubElement(root, "product")
-            
-            for key, value in item.items():
-                # Создаем валидное имя тега
-                tag_name = create_valid_xml_tag(key)
-                
-                field_elem = ET.SubElement(product_elem, tag_name)
-                
-                # Экранируем специальные XML символы
-                if value is not None:
-                    # Заменяем все специальные XML символы
-                    text_content = str(value)
-                    text_content = text_content.replace("&", "&amp;")
-                    text_content = text_content.replace("<", "&lt;")
-                    text_content = text_content.replace(">", "&gt;")
-                    text_content = text_content.replace('"', "&quot;")
-                    text_content = text_content.replace("'", "&apos;")
-                    field_elem.text = text_content
-                else:
-                    field_elem.text = ""
-        
-        # Создаем дерево и сохраняем с форматированием
-        tree = ET.ElementTree(root)
-        
-        # Добавляем отступы для читаемости
-        def indent(elem, level=0):
-            i = "\n" + level * "  "
-            if len(elem):
-                if not elem.text or not elem.text.strip():
-                    elem.text = i + "  "
-                if not elem.tail or not elem.tail.strip():
-                    elem.tail = i
-                for elem in elem:
-                    indent(elem, level + 1)
-                if not elem.tail or not elem.tail.strip():
-                    elem.tail = i
-            else:
-                if level and (not elem.tail or not elem.tail.strip()):
-                    elem.tail = i
-        
-        indent(root)
-        
-        # Сохраняем с XML декларацией
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-            tree.write(f, encoding='unicode')
-        
+        sink = XmlSink(filename)
+        try:
+            batch = []
+            for item in data:
+                batch.append(item)
+                if len(batch) >= 500:
+                    sink.write_batch(batch)
+                    batch = []
+            sink.write_batch(batch)
+        finally:
+            sink.close()
         print(f"💾 XML данные сохранены в {filename}")
         return True
     except Exception as e:
@@ -290,49 +2077,767 @@ def save_to_xml(data, filename):
         return False
 
 
-def check_elems(arr) -> list:
-    links = get_pages()
-    if not links:
+# === Кэш ответов ===
+class ResponseCache:
+    """Сжатый кэш сырых ответов API с адресацией по содержимому.
+
+    Ответ хранится один раз в objects/<sha256>.json.gz, а SQLite-индекс связывает
+    (ID товара, эндпоинт) с хешем ответа, временем загрузки и последнего использования.
+    Одинаковые ответы (например, пустые рекомендации) занимают место один раз.
+    Свежие по fresh ответы необязательных эндпоинтов отдаются вместо запроса (lookup_fresh).
+
+    Ответы пишет на диск один фоновый поток: put_item только сериализует их и ставит в очередь
+    (не больше WRITE_QUEUE товаров, дальше put_item ждёт). Записи индекса и время
+    использования копятся в памяти и пишутся одной транзакцией раз в COMMIT_EVERY изменений:
+    коммит на каждый ответ упирался в fsync и общую блокировку.
+    """
+
+    COMMIT_EVERY = 500
+    WRITE_QUEUE = 1000
+
+    def __init__(self, directory, ttls=None, fresh=None):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, "objects")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.ttls = ttls if ttls is not None else CACHE_TTLS
+        self.fresh = fresh if fresh is not None else CACHE_FRESH
+        self.lock = threading.Lock()
+        self.pending = []    # строки entries, ещё не записанные в индекс
+        self.touched = {}    # (ID, эндпоинт) -> время использования, ещё не записанное
+        self.conn = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "item_id TEXT NOT NULL, endpoint TEXT NOT NULL, digest TEXT NOT NULL, fetched_at REAL NOT NULL, "
+            "used_at REAL NOT NULL DEFAULT 0, PRIMARY KEY (item_id, endpoint))"
+        )
+        # Кэш, созданный до вытеснения по LRU: время использования начинаем со времени загрузки
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(entries)")}
+        if "used_at" not in columns:
+            self.conn.execute("ALTER TABLE entries ADD COLUMN used_at REAL NOT NULL DEFAULT 0")
+            self.conn.execute("UPDATE entries SET used_at = fetched_at")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_used_at ON entries (used_at)")
+        self.conn.commit()
+        self.writes = queue.Queue(maxsize=self.WRITE_QUEUE)
+        self.writer = threading.Thread(target=self._write_loop, name="iherb-cache", daemon=True)
+        self.writer.start()
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], f"{digest}.json.gz")
+
+    def _write_object(self, payload):
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(gzip.compress(payload, compresslevel=6))
+            os.replace(tmp_path, path)
+        return digest
+
+    def _read_object(self, digest):
+        with open(self._object_path(digest), "rb") as f:
+            return json_loads(gzip.decompress(f.read()))
+
+    def _flush(self):
+        """Пишем накопленные изменения индекса одной транзакцией; вызывать под self.lock"""
+        if self.pending:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO entries (item_id, endpoint, digest, fetched_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                self.pending,
+            )
+        if self.touched:
+            self.conn.executemany(
+                "UPDATE entries SET used_at = ? WHERE item_id = ? AND endpoint = ?",
+                [(used_at, item_id, endpoint) for (item_id, endpoint), used_at in self.touched.items()],
+            )
+        self.conn.commit()
+        self.pending = []
+        self.touched = {}
+
+    def _changed(self):
+        if len(self.pending) + len(self.touched) >= self.COMMIT_EVERY:
+            self._flush()
+
+    def flush(self):
+        """Дожидаемся записи ответов из очереди и пишем индекс"""
+        self.writes.join()
+        with self.lock:
+            self._flush()
+
+    def put_item(self, item_id, product_data, optional_data):
+        """Ставим в очередь записи все удачные ответы товара (вызывается до merge_optional_data)"""
+        # Сериализуем сразу: после возврата merge_optional_data меняет product_data
+        payloads = [
+            (endpoint, json_dumps_bytes(data))
+            for endpoint, data in {"product": product_data, **optional_data}.items() if data is not None
+        ]
+        self.writes.put((str(item_id), time.time(), payloads))
+
+    def _write_loop(self):
+        while True:
+            job = self.writes.get()
+            try:
+                if job is None:
+                    return
+                item_id, fetched_at, payloads = job
+                rows = [
+                    (item_id, endpoint, self._write_object(payload), fetched_at, fetched_at)
+                    for endpoint, payload in payloads
+                ]
+                with self.lock:
+                    self.pending.extend(rows)
+                    self._changed()
+            except (OSError, sqlite3.Error) as e:
+                print(f"⚠️ Не удалось сохранить ответы {job[0]} в кэш: {e}")
+            finally:
+                self.writes.task_done()
+
+    def get(self, item_id, endpoint, max_age=None):
+        """Ответ из индекса; ещё не записанные в него ответы (pending) не видны — это лишь лишний запрос"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest, fetched_at FROM entries WHERE item_id = ? AND endpoint = ?", (str(item_id), endpoint)
+            ).fetchone()
+        if row is None or (max_age is not None and time.time() - row[1] > max_age):
+            return None
+        try:
+            data = self._read_object(row[0])
+        except (OSError, ValueError):
+            return None
+        with self.lock:
+            self.touched[str(item_id), endpoint] = time.time()
+            self._changed()
+        return data
+
+    def lookup_fresh(self, item_id, endpoints):
+        """Свежие по self.fresh ответы из endpoints: {эндпоинт: ответ}; их можно не загружать"""
+        hits = {}
+        for endpoint in endpoints:
+            max_age = self.fresh.get(endpoint)
+            if max_age:
+                data = self.get(item_id, endpoint, max_age)
+                if data is not None:
+                    hits[endpoint] = data
+        return hits
+
+    def iter_items(self):
+        """Все закэшированные товары: (ID, ответ товара, {эндпоинт: ответ}).
+
+        Курсор читается лениво, поэтому параллельно с загрузкой (put) не вызывать.
+        """
+        self.flush()
+        rows = self.conn.execute("SELECT item_id, endpoint, digest FROM entries ORDER BY item_id")
+        for item_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+            digests = {endpoint: digest for _, endpoint, digest in group}
+            if "product" not in digests:
+                continue
+            try:
+                product_data = self._read_object(digests.pop("product"))
+                optional_data = {endpoint: self._read_object(digest) for endpoint, digest in digests.items()}
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Повреждённая запись кэша для {item_id}: {e}")
+                continue
+            yield item_id, product_data, optional_data
+
+    def purge_expired(self):
+        """Удаляем записи старше TTL своего эндпоинта и файлы, на которые больше никто не ссылается"""
+        now = time.time()
+        # Сначала дожидаемся очереди записи: иначе её файлы ещё не упомянуты в индексе и будут удалены
+        self.flush()
+        with self.lock:
+            removed = 0
+            for endpoint, ttl in self.ttls.items():
+                removed += self.conn.execute(
+                    "DELETE FROM entries WHERE endpoint = ? AND fetched_at < ?", (endpoint, now - ttl)
+                ).rowcount
+            self.conn.commit()
+        if removed:
+            self._remove_unreferenced()
+        return removed
+
+    def evict(self, max_entries=CACHE_MAX_ENTRIES):
+        """Вытесняем записи сверх max_entries, начиная с давно не использованных (LRU)"""
+        # Как и в purge_expired: после очереди записи COUNT(*) видит и ещё не записанные ответы
+        self.flush()
+        with self.lock:
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+            if count <= max_entries:
+                return 0
+            removed = self.conn.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY used_at LIMIT ?)",
+                (count - max_entries,),
+            ).rowcount
+            self.conn.commit()
+        self._remove_unreferenced()
+        return removed
+
+    def _remove_unreferenced(self):
+        """Удаляем файлы ответов, на которые больше не ссылается ни одна запись"""
+        snapshot_at = time.time()
+        with self.lock:
+            alive = {digest for (digest,) in self.conn.execute("SELECT DISTINCT digest FROM entries")}
+        for root, _, files in os.walk(self.objects_dir):
+            for name in files:
+                if not name.endswith(".json.gz") or name[:-len(".json.gz")] in alive:
+                    continue
+                path = os.path.join(root, name)
+                # Файл, записанный после снимка, ещё ждёт своей строки в индексе (pending)
+                with contextlib.suppress(FileNotFoundError):
+                    if os.path.getmtime(path) < snapshot_at:
+                        os.remove(path)
+
+    def close(self):
+        self.writes.put(None)
+        self.writer.join()
+        with self.lock:
+            self._flush()
+        self.conn.close()
+
+
+def cache_fresh_spec(spec):
+    """Разбираем значение --cache-fresh вида endpoint=days (0 — всегда загружать заново)"""
+    endpoint, _, days = spec.partition("=")
+    if endpoint not in CACHE_FRESH:
+        raise argparse.ArgumentTypeError(
+            f"неверный эндпоинт: {endpoint} (из кэша можно брать только {', '.join(CACHE_FRESH)})"
+        )
+    try:
+        return endpoint, float(days) * 86400
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"неверный срок: {spec} (ожидается endpoint=days)")
+
+
+def iter_cached_batches(cache, batch_size=300, shard=None):
+    """Сырые ответы из кэша пакетами, в том же виде, что отдаёт загрузка"""
+    batch = []
+    for item_id, product_data, optional_data in cache.iter_items():
+        if not in_shard(item_id, shard):
+            continue
+        merge_optional_data(product_data, optional_data)
+        batch.append(product_data)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def replay_elems(sinks, cache, batch_size=300, parse_workers=0, shard=None, fields=None) -> int:
+    """Парсим товары только из кэша ответов, без единого сетевого запроса"""
+    replayed = 0
+    batches = iter_cached_batches(cache, batch_size, shard)
+    for parsed_batch in iter_parsed_batches(batches, parse_workers, fields):
+        write_to_sinks(sinks, parsed_batch)
+        replayed += len(parsed_batch)
+    return replayed
+
+
+# === Журнал обхода ===
+class CrawlJournal:
+    """SQLite-журнал готовых товаров: по нему --resume пропускает загруженное и собирает итоговые файлы"""
+
+    def __init__(self, filename, reset=False):
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, record TEXT NOT NULL, done_at REAL NOT NULL)"
+        )
+        if reset:
+            self.conn.execute("DELETE FROM items")
+        self.conn.commit()
+
+    def done_ids(self):
+        return {row[0] for row in self.conn.execute("SELECT id FROM items")}
+
+    def write_batch(self, records):
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO items (id, record, done_at) VALUES (?, ?, ?)",
+            [(str(r["ID"]), json_dumps(r), now) for r in records],
+        )
+        self.conn.commit()
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def iter_records(self):
+        for (record,) in self.conn.execute("SELECT record FROM items ORDER BY rowid"):
+            yield json_loads(record)
+
+    def iter_batches(self, size=500):
+        batch = []
+        for record in self.iter_records():
+            batch.append(record)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def close(self):
+        self.conn.close()
+
+
+# === Индекс товаров для инкрементального обхода ===
+class ProductIndex:
+    """SQLite-индекс товаров между запусками: lastmod из sitemap, хеш записи и сама запись.
+
+    Ссылки планируются в потоке движка загрузки, а записи обновляются в основном,
+    поэтому соединение общее для потоков и защищено блокировкой.
+    """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS products ("
+            "id TEXT PRIMARY KEY, lastmod TEXT, content_hash TEXT NOT NULL, "
+            "fetched_at REAL NOT NULL, record TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def is_fresh(self, item_id, lastmod, max_age):
+        """Товар не менялся: тот же lastmod в sitemap и запись не старше max_age секунд"""
+        if lastmod is None:
+            return False
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT lastmod, fetched_at FROM products WHERE id = ?", (item_id,)
+            ).fetchone()
+        return row is not None and row[0] == lastmod and time.time() - row[1] < max_age
+
+    def update_batch(self, records, lastmods):
+        """Сохраняем свежие записи; возвращаем, сколько из них действительно изменилось"""
+        now = time.time()
+        rows = []
+        for record in records:
+            item_id = str(record["ID"])
+            # Хеш не должен зависеть от того, установлен ли orjson, поэтому здесь стандартный json
+            payload = json.dumps(record, ensure_ascii=False, sort_keys=True)
+            rows.append((item_id, lastmods.pop(item_id, None), hashlib.sha256(payload.encode()).hexdigest(),
+                         now, payload))
+        with self.lock:
+            known = dict(self.conn.execute(
+                f"SELECT id, content_hash FROM products WHERE id IN ({','.join('?' * len(rows))})",
+                [row[0] for row in rows],
+            )) if rows else {}
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO products (id, lastmod, content_hash, fetched_at, record) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+        return sum(1 for row in rows if known.get(row[0]) != row[2])
+
+    def records(self, item_ids):
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT record FROM products WHERE id IN ({','.join('?' * len(item_ids))})", list(item_ids)
+            ).fetchall() if item_ids else []
+        return [json_loads(record) for (record,) in rows]
+
+    def close(self):
+        self.conn.close()
+
+
+def plan_links(entries, index, lastmods, carried, incremental=False, max_age=0):
+    """Отбираем ссылки для загрузки.
+
+    lastmod каждой отобранной ссылки запоминается в lastmods для индекса. В инкрементальном
+    режиме товары без изменений не загружаются: их ID складываются в carried, чтобы перенести
+    прошлые записи в результаты.
+    """
+    for link, lastmod in entries:
+        item_id = item_id_from_link(link)
+        if incremental and index.is_fresh(item_id, lastmod, max_age):
+            carried.append(item_id)
+            continue
+        lastmods[item_id] = lastmod
+        yield link
+
+
+def write_to_sinks(sinks, records):
+    for sink in sinks:
+        sink.write_batch(records)
+
+
+def carry_forward(carried, index, sinks, fields=None):
+    """Переносим записи неизменившихся товаров из индекса в результаты текущего запуска"""
+    item_ids = []
+    while carried:
+        item_ids.append(carried.popleft())
+    for start in range(0, len(item_ids), 500):
+        records = index.records(item_ids[start:start + 500])
+        write_to_sinks(sinks, [select_fields(record, fields) for record in records])
+    return len(item_ids)
+
+
+def skip_done(entries, done_ids):
+    """Убираем из пар (ссылка, lastmod) товары, уже записанные в журнал"""
+    return (entry for entry in entries if item_id_from_link(entry[0]) not in done_ids)
+
+
+# === Шарды ===
+def shard_spec(spec):
+    """Разбираем значение --shard вида i/N; шарды нумеруются с 1"""
+    index, _, count = spec.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"неверный шард: {spec} (ожидается i/N, например 2/4)")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"неверный шард: {spec} (номер от 1 до {count})")
+    return index, count
+
+
+def shard_of(item_id, count):
+    """Шард товара: стабильный хеш ID, одинаковый на всех узлах и во всех запусках (в отличие от hash())"""
+    digest = hashlib.sha1(str(item_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count + 1
+
+
+def in_shard(item_id, shard):
+    return shard is None or shard_of(item_id, shard[1]) == shard[0]
+
+
+def shard_path(path, shard):
+    """results/iherb.json -> results/iherb.shard-2-of-4.json; без шарда путь не меняется"""
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+def iter_shard_records(filename):
+    """Записи из выходного файла шарда: JSON-массив или JSONL"""
+    with open(filename, "rb") as f:
+        if filename.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json_loads(line)
+        else:
+            yield from json_loads(f.read())
+
+
+def merge_shards(count, output_format="json"):
+    """Собираем выходные файлы шардов 1..count в итоговые iherb.json/iherb.xml.
+
+    Повторы ID (товар попал в два шарда) пропускаем, оставляя первую запись. Пропуски — это
+    отсутствующие файлы шардов и товары из dead-letter файлов, которых нет ни в одном выводе.
+    Итоговые файлы пишутся во временные и подменяются только после успешного слияния.
+    """
+    sink_class, json_file = OUTPUT_FORMATS[output_format]
+    shard_files = {number: shard_path(json_file, (number, count)) for number in range(1, count + 1)}
+    if not any(os.path.exists(filename) for filename in shard_files.values()):
+        # Скорее всего, запуск не из той папки: прошлые итоговые файлы не трогаем
+        print(f"❌ Нет вывода ни одного из {count} шардов (например, {shard_files[1]}), "
+              f"{json_file} и {XML_FILE} не изменены")
+        return {"merged": 0, "duplicates": 0, "misplaced": 0, "missing_shards": list(shard_files), "lost": []}
+    json_sink = sink_class(f"{json_file}.tmp")
+    xml_sink = XmlSink(f"{XML_FILE}.tmp")
+    merged = False
+    seen = set()
+    duplicates = collections.Counter()
+    misplaced = 0
+    missing_shards = []
+    failed = {}
+    try:
+        for number in range(1, count + 1):
+            shard = (number, count)
+            filename = shard_files[number]
+            if not os.path.exists(filename):
+                missing_shards.append(number)
+                print(f"❌ Нет вывода шарда {number}/{count}: {filename}")
+                continue
+            for link in read_dead_letter(shard_path(DEAD_LETTER_FILE, shard)):
+                failed[item_id_from_link(link)] = number
+            batch = []
+            records = 0
+            for record in iter_shard_records(filename):
+                records += 1
+                item_id = str(record.get("ID", ""))
+                if item_id in seen:
+                    duplicates[item_id] += 1
+                    continue
+                seen.add(item_id)
+                if not in_shard(item_id, shard):
+                    misplaced += 1
+                batch.append(record)
+                if len(batch) >= 500:
+                    write_to_sinks([json_sink, xml_sink], batch)
+                    batch = []
+            write_to_sinks([json_sink, xml_sink], batch)
+            print(f"🧩 Шард {number}/{count}: {records} записей из {filename}")
+        merged = True
+    finally:
+        json_sink.close()
+        xml_sink.close()
+        for tmp_file, final_file in ((json_sink.filename, json_file), (xml_sink.filename, XML_FILE)):
+            if merged:
+                os.replace(tmp_file, final_file)
+            else:
+                os.remove(tmp_file)
+
+    lost = sorted(item_id for item_id in failed if item_id not in seen)
+    print(f"💾 Объединено {json_sink.count} товаров в {json_file} и {XML_FILE}")
+    if duplicates:
+        print(f"⚠️ Повторы: {len(duplicates)} ID встретились больше одного раза "
+              f"(например, {', '.join(list(duplicates)[:5])}), оставлена первая запись")
+    if misplaced:
+        print(f"⚠️ Не в своём шарде: {misplaced} товаров — шарды запускались с разным N?")
+    if missing_shards:
+        print(f"⚠️ Пропуски: нет вывода шардов {', '.join(map(str, missing_shards))}")
+    if lost:
+        print(f"⚠️ Пропуски: {len(lost)} товаров не загружены ни одним шардом "
+              f"(например, {', '.join(lost[:5])}), см. dead-letter файлы шардов")
+    if not (duplicates or misplaced or missing_shards or lost):
+        print("✅ Пропусков и повторов нет")
+    return {"merged": json_sink.count, "duplicates": len(duplicates), "misplaced": misplaced,
+            "missing_shards": missing_shards, "lost": lost}
+
+
+def check_elems(sinks, args, dead_letter=None, links=None, journal=None, index=None, cache=None,
+                sitemaps=None) -> int:
+    """Загружаем и парсим товары, каждый готовый пакет сразу отдаём в sinks; возвращаем число загруженных"""
+    if links is not None:
+        entries = ((link, None) for link in links)
+    elif args.cids:
+        entries = iter_category_entries(args.cids)
+    else:
+        entries = iter_sitemap_entries(sitemaps=sitemaps)
+    if args.shard is not None:
+        entries = (entry for entry in entries if in_shard(item_id_from_link(entry[0]), args.shard))
+    if journal is not None and args.resume:
+        # До plan_links: записи из журнала уже выгружены в результаты, переносить их из индекса второй раз нельзя
+        done_ids = journal.done_ids()
+        entries = skip_done(entries, done_ids)
+        print(f"⏭️ Пропускаем {len(done_ids)} товаров, уже загруженных в прошлый раз")
+    lastmods = {}
+    carried = collections.deque()
+    if index is not None:
+        links = plan_links(entries, index, lastmods, carried, args.incremental, args.max_age * 86400)
+    else:
+        links = (link for link, _ in entries)
+
+    endpoints = endpoints_for_fields(args.fields)
+    if endpoints is not None:
+        print(f"🧩 Поля: {', '.join(args.fields)}; запросов на товар: {1 + len(endpoints)} "
+              f"(product{''.join(', ' + name for name in sorted(endpoints))})")
+    # Ссылки приходят генератором, поэтому пустой список видно только после обхода
+    links_seen_before = METRICS.links_seen
+    reporter = ProgressReporter(METRICS, args.progress, args.progress_interval).start()
+    batches = get_items_json_batched(
+        count_links(links, METRICS), engine=args.engine, max_workers=args.workers, batch_size=args.batch_size,
+        max_in_flight=args.max_in_flight, adaptive=args.adaptive, min_workers=args.min_workers,
+        target_latency=args.target_latency, on_failure=dead_letter.record if dead_letter else None,
+        cache=cache, session_mode=args.sessions, endpoints=endpoints,
+    )
+    fetched = carried_count = changed = 0
+    try:
+        for batch_num, parsed_batch in enumerate(iter_parsed_batches(batches, args.parse_workers, args.fields)):
+            if args.progress == "text":
+                print(f"📦 Обрабатываем пакет {batch_num + 1}...")
+            # Индекс пишем раньше журнала: товары из журнала --resume пропускает, и после падения
+            # между ними их записей не было бы в индексе. Индекс хранит только полные записи
+            if index is not None and args.fields is None:
+                changed += index.update_batch(parsed_batch, lastmods)
+            write_to_sinks(sinks, parsed_batch)
+            fetched += len(parsed_batch)
+            if index is not None:
+                carried_count += carry_forward(carried, index, sinks, args.fields)
+    finally:
+        reporter.stop()
+    if METRICS.links_seen == links_seen_before and not carried_count and not carried:
         print("❌ Нет ссылок для обработки.")
-        return
-    
-    for batch_num, batch_json in enumerate(get_items_json_threaded_batched(links)):
-        print(f"📦 Обрабатываем пакет {batch_num + 1}...")
-        for item_json in batch_json:
-            parsed = parse_item(item_json)
-            if parsed:
-                arr.append(parsed)
+    if index is not None:
+        carried_count += carry_forward(carried, index, sinks, args.fields)
+        if args.incremental:
+            print(f"🔁 Без изменений (перенесено из индекса): {carried_count}, "
+                  f"загружено заново: {fetched}, из них изменилось: {changed}")
     
-    return arr
+    return fetched
 
 
-def main_iherb():
-    start = time.perf_counter()
-    print("🚀 Запуск парсинга iHerb...")
+def positive_int(spec):
+    """Целое число не меньше 1 — для числа потоков, товаров в работе и шардов"""
+    try:
+        value = int(spec)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается целое число: {spec}")
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"ожидается число не меньше 1: {spec}")
+    return value
 
-    all_items = []
 
-    newarr = check_elems(all_items)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Парсер каталога iHerb")
+    parser.add_argument("--engine", choices=ENGINES, default="threads",
+                        help="движок загрузки: потоки или asyncio (нужен aiohttp)")
+    parser.add_argument("--workers", type=positive_int, default=None,
+                        help="число одновременных загрузок (по умолчанию: threads=40, async=500)")
+    parser.add_argument("--batch-size", type=int, default=300, help="размер пакета товаров")
+    parser.add_argument("--max-in-flight", type=positive_int, default=None,
+                        help="сколько товаров держать в работе одновременно (по умолчанию threads: 2 x workers, async: workers)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="подбирать параллелизм автоматически (AIMD), --workers становится потолком")
+    parser.add_argument("--min-workers", type=positive_int, default=1, help="нижняя граница для --adaptive")
+    parser.add_argument("--target-latency", type=float, default=3.0,
+                        help="для --adaptive: средняя задержка товара (с), выше которой лимит не растёт")
+    parser.add_argument("--sessions", choices=SESSION_MODES, default="shared",
+                        help="для --engine threads: одна сессия с пулом соединений на все потоки или своя у каждого")
+    parser.add_argument("--parse-workers", type=int, default=0,
+                        help=f"сколько процессов парсят пакеты (0 — в основном потоке; ядер: {os.cpu_count()})")
+    parser.add_argument("--rate", action="append", type=rate_limit_spec, default=[], metavar="HOST=RPS[:BURST]",
+                        help="лимит запросов в секунду на хост, можно указывать несколько раз (0 — без лимита)")
+    parser.add_argument("--retries", type=int, default=RETRY_POLICY.retries,
+                        help="сколько раз повторять временные ошибки (таймаут, 429/5xx, проверка Cloudflare)")
+    parser.add_argument("--retry-dead-letter", action="store_true",
+                        help=f"загрузить заново только товары из {DEAD_LETTER_FILE} и добавить их к результатам")
+    parser.add_argument("--output-format", choices=sorted(OUTPUT_FORMATS), default="json",
+                        help="json — потоково записываемый массив в iherb.json, jsonl — iherb.jsonl (товар на строку)")
+    parser.add_argument("--table", action="append", choices=sorted(TABLE_FORMATS), default=[],
+                        help="дополнительно писать товары в таблицу: sqlite — upsert по ID в iherb.sqlite, "
+                             "parquet — iherb.parquet с числовыми ценой и рейтингом (нужен pyarrow)")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"загружать только новые товары и товары с изменившимся lastmod (по {INDEX_FILE})")
+    parser.add_argument("--max-age", type=float, default=7,
+                        help="для --incremental: через сколько дней загружать товар заново даже без изменений")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help=f"не сохранять сырые ответы API в {CACHE_DIR} и не брать из него recommendations/ugc")
+    parser.add_argument("--cache-fresh", action="append", type=cache_fresh_spec, default=[],
+                        metavar="ENDPOINT=DAYS",
+                        help="сколько дней брать ответ recommendations/ugc из кэша вместо запроса "
+                             f"(по умолчанию {', '.join(f'{k}={v / 86400:g}' for k, v in CACHE_FRESH.items())}; "
+                             "0 — всегда загружать)")
+    parser.add_argument("--cache-max-entries", type=int, default=CACHE_MAX_ENTRIES,
+                        help="сколько записей держит кэш ответов; лишние вытесняются по давности использования")
+    parser.add_argument("--replay", action="store_true",
+                        help=f"без сети: распарсить заново все товары из {CACHE_DIR}")
+    parser.add_argument("--progress", choices=PROGRESS_MODES, default="text",
+                        help="сводка прогресса: строкой, JSON-строкой для сборщика логов или без неё")
+    parser.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL,
+                        help="как часто печатать сводку прогресса, секунды")
+    parser.add_argument("--metrics-file", default=METRICS_FILE,
+                        help="textfile с метриками Prometheus, переписывается во время обхода (пустая строка — не писать)")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                        help="как часто переписывать --metrics-file, секунды")
+    parser.add_argument("--cids", type=cid_list, nargs="?", const=tuple(CATEGORY_IDS.values()), default=None,
+                        metavar="ID,ID,...",
+                        help="загружать только товары этих категорий (по листингам, без sitemap); "
+                             "без значения — категории из README")
+    parser.add_argument("--fields", type=field_list, default=None, metavar="FIELD,FIELD,...",
+                        help="вывести только эти поля (ID всегда); эндпоинты, не нужные для них, не запрашиваются")
+    parser.add_argument("--shard", type=shard_spec, default=None, metavar="I/N",
+                        help="загружать только свою долю товаров (стабильный хеш ID); файлы получают суффикс .shard-I-of-N")
+    parser.add_argument("--merge", type=positive_int, default=None, metavar="N",
+                        help="объединить вывод шардов 1..N в итоговые iherb.json/iherb.xml и сообщить о пропусках и повторах")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"продолжить прерванный запуск: пропустить товары из {JOURNAL_FILE}")
+    return parser.parse_args(argv)
 
-    # Сохраняем в JSON
-    json_filename = "results/iherb.json"
-    with open(json_filename, "w", encoding="utf-8") as f:
-        json.dump(newarr, f, ensure_ascii=False, indent=2)
-    print(f"💾 JSON данные сохранены в {json_filename}")
 
-    # Сохраняем в XML
-    xml_filename = "results/iherb.xml"
-    if save_to_xml(newarr, xml_filename):
-        print(f"✅ XML файл успешно создан и должен открываться без ошибок")
+def main_iherb(args=None):
+    if args is None:
+        args = parse_args([])
+    if args.merge is not None:
+        merge_shards(args.merge, args.output_format)
+        return
+    RATE_LIMITER.configure({**RATE_LIMITS, **dict(args.rate)})
+    RETRY_POLICY.retries = args.retries
+    start = time.perf_counter()
+    if not args.replay:
+        CLEARANCE_STORE.load()
+    if args.replay:
+        print(f"🚀 Запуск парсинга iHerb из кэша {CACHE_DIR} (без сети)...")
     else:
-        print(f"❌ Не удалось создать XML файл")
+        print(f"🚀 Запуск парсинга iHerb (движок: {args.engine})...")
+    if args.shard is not None:
+        print(f"🧩 Шард {args.shard[0]}/{args.shard[1]}")
+    # У каждого шарда свои результаты, журнал, индекс и dead-letter; кэш ответов общий
+    dead_letter_file = shard_path(DEAD_LETTER_FILE, args.shard)
+
+    links = None
+    if args.retry_dead_letter:
+        links = read_dead_letter(dead_letter_file)
+        print(f"♻️ Повторная загрузка {len(links)} товаров из {dead_letter_file}")
+
+    # Индекс sitemap читаем до открытия журнала и результатов: если он недоступен,
+    # запуск падает, не перезаписав iherb.json, iherb.xml и журнал
+    sitemaps = None
+    if links is None and not args.cids and not args.replay:
+        sitemaps = get_product_sitemaps(create_scraper())
+
+    # Журнал сбрасывается только при новом полном запуске: --resume и --retry-dead-letter дополняют его
+    continuing = (args.resume or args.retry_dead_letter) and not args.replay
+    journal = CrawlJournal(shard_path(JOURNAL_FILE, args.shard), reset=not continuing)
+    index = ProductIndex(shard_path(INDEX_FILE, args.shard))
+    cache = ResponseCache(CACHE_DIR, fresh={**CACHE_FRESH, **dict(args.cache_fresh)}) \
+        if args.cache or args.replay else None
+    if cache is not None and not args.replay:
+        purged = cache.purge_expired()
+        if purged:
+            print(f"🧹 Удалено устаревших ответов из кэша: {purged}")
+    dead_letter = None if args.replay else DeadLetter(dead_letter_file, verbose=args.progress == "text")
+    # Таблицы открываем первыми: без pyarrow запуск падает до того, как перезаписаны iherb.json и iherb.xml
+    table_sinks = [open_table_sink(table_format, args.shard) for table_format in dict.fromkeys(args.table)]
+    json_sink = open_json_sink(args.output_format, args.shard)
+    xml_sink = XmlSink(shard_path(XML_FILE, args.shard))
+    output_sinks = [json_sink, xml_sink] + table_sinks
+    exporter = None
+    if args.metrics_file and not args.replay:
+        exporter = MetricsExporter(METRICS, shard_path(args.metrics_file, args.shard), args.metrics_interval).start()
+    try:
+        if continuing:
+            # Файлы результатов пишутся заново, поэтому сначала выгружаем в них товары прошлых запусков
+            for records in journal.iter_batches():
+                write_to_sinks(output_sinks, records)
+        if args.replay:
+            fetched = replay_elems([journal] + output_sinks, cache, args.batch_size, args.parse_workers, args.shard,
+                                   args.fields)
+        else:
+            fetched = check_elems([journal] + output_sinks, args, dead_letter, links, journal, index, cache,
+                                  sitemaps)
+            if cache is not None:
+                evicted = cache.evict(args.cache_max_entries)
+                if evicted:
+                    print(f"🧹 Вытеснено из кэша давно не использованных ответов: {evicted}")
+    finally:
+        for sink in output_sinks:
+            sink.close()
+        if dead_letter is not None:
+            dead_letter.close()
+        journal.close()
+        index.close()
+        if cache is not None:
+            cache.close()
+        if not args.replay:
+            CLEARANCE_STORE.save()
+        if exporter is not None:
+            exporter.stop()
+    print(f"💾 JSON данные сохранены в {json_sink.filename}")
+    print(f"💾 XML данные сохранены в {xml_sink.filename}")
+    for sink in table_sinks:
+        print(f"💾 Таблица сохранена в {sink.filename} ({sink.count} товаров)")
 
     end = time.perf_counter()
-    print(f"\n✅ Парсинг завершён: {len(all_items)} товаров за {end - start:.2f} сек.")
+    print(f"\n✅ Парсинг завершён: {fetched} товаров за {end - start:.2f} сек. (всего в результатах: {json_sink.count})")
+    if dead_letter is not None and dead_letter.count:
+        print(f"⚠️ Не удалось загрузить {dead_letter.count} товаров, см. {dead_letter_file} (--retry-dead-letter)")
+    if not args.replay:
+        METRICS.summary()
     print(f"💾 Данные сохранены в:")
-    print(f"   - {json_filename}")
-    print(f"   - {xml_filename}")
+    print(f"   - {json_sink.filename}")
+    print(f"   - {xml_sink.filename}")
+    for sink in table_sinks:
+        print(f"   - {sink.filename}")
 
 
 if __name__ == "__main__":
-    main_iherb()
+    main_iherb(parse_args())